@@ -47,4 +47,8 @@ print(param, path)
 #iterate over all data in dataset
 for param, path in dataset:
     print(param, path)
-    data = LocustP3File(path / 'someFileName.egg')
\ No newline at end of file
+    data = LocustP3File(path / 'someFileName.egg')
+
+#iterate over all data in dataset and load the files in the background
+for param, data in dataset.iter_prefetch(lambda path: LocustP3File(path / 'someFileName.egg')):
+    print(param, data)
@@ -6,16 +6,57 @@ Date: February 17, 2021
 
 """
 
+import importlib
 
-from .simulation import KassLocustP3
-from .simconfig import SimConfig, SimpleSimConfig, ConfigList
-from .eggreader import LocustP3File
-from .dataset import Dataset
-from .pyjob import PyJob
+# the public classes are imported from their submodules on first access
+_SUBMODULES = {'KassLocustP3': '.simulation',
+               'SimConfig': '.simconfig',
+               'SimpleSimConfig': '.simconfig',
+               'ConfigList': '.simconfig',
+               'LocustP3File': '.eggreader',
+               'Dataset': '.dataset',
+               'PyJob': '.pyjob'}
 
-from . import _version
-from . import _versionhelper
+# submodules that used to be loaded on import and are still reachable as attributes
+_MODULES = {'simulation', 'simconfig', 'eggreader', 'dataset', 'pyjob',
+            'constants', 'configuration', '_version', '_versionhelper'}
 
-__version__ = _version.get_versions()['version']
-__hexbug_version__ = _versionhelper.get_hexbug_commit_version()
-__python_script_version__ = _versionhelper.get_python_dir_commit_version()
+
+def _get_version():
+    from . import _version
+    return _version.get_versions()['version']
+
+def _get_hexbug_version():
+    from . import _versionhelper
+    return _versionhelper.get_hexbug_commit_version()
+
+def _get_python_script_version():
+    from . import _versionhelper
+    return _versionhelper.get_python_dir_commit_version()
+
+# the versions are computed on first access since they might have to query git
+_VERSIONS = {'__version__': _get_version,
+             '__hexbug_version__': _get_hexbug_version,
+             '__python_script_version__': _get_python_script_version}
+
+# star imports go through __getattr__ as well
+__all__ = [*_SUBMODULES, *_VERSIONS]
+
+
+def __getattr__(name):
+
+    if name in _SUBMODULES:
+        value = getattr(importlib.import_module(_SUBMODULES[name], __name__), name)
+    elif name in _VERSIONS:
+        value = _VERSIONS[name]()
+    elif name in _MODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    # cache it, later accesses do not go through __getattr__
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_VERSIONS) | _MODULES)
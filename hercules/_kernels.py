@@ -0,0 +1,26 @@
+
+
+# Optional compiled kernels, the callers fall back to numpy if numba is not installed
+
+try:
+    from numba import njit
+except ImportError:
+    fill_acquisition = None
+else:
+    # no parallel=True, the default threading layer aborts on concurrent launches
+    # and records are converted on the reading threads of the egg loaders
+    @njit(fastmath=True, cache=True)
+    def fill_acquisition(raw, channel_major, scale, offset, out):
+        # Deinterleave the raw records of an egg acquisition into out with shape
+        # (n_records, n_channels, record_size) and convert to volts, reading every raw sample once
+        n_records, n_ch, n_samples = out.shape
+        for j in range(n_records):
+            record = raw[j]
+            for k in range(n_ch):
+                for i in range(n_samples):
+                    if channel_major:
+                        p = 2 * (k * n_samples + i)
+                    else:
+                        p = 2 * (i * n_ch + k)
+                    out[j, k, i] = complex(record[p] * scale[k] + offset[k],
+                                           record[p + 1] * scale[k] + offset[k])
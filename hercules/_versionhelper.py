@@ -1,7 +1,7 @@
 
 
-import git
 from pathlib import Path
+from functools import lru_cache
 
 _hexbug_dir = Path(__file__).parent.absolute() / 'hexbug'
 _hexbug_version_file = _hexbug_dir / 'hexbugversion'
@@ -23,22 +23,29 @@ def get_python_dir_commit_version():
     python_dir = Path(CONFIG.python_script_path)
     return get_git_commit_version(python_dir)
 
-def is_git_repo(path):
+@lru_cache(maxsize=8)
+def _open_repo(path):
+    # Return a cached repository handle or None if path is not in a git repo
+    # gitpython is imported on demand since it is expensive to import
+    import git
     try:
-        _ = git.Repo(path, search_parent_directories=True).git_dir
-        return True
+        return git.Repo(path, search_parent_directories=True)
     except git.exc.InvalidGitRepositoryError:
-        return False
+        return None
+
+def is_git_repo(path):
+    return _open_repo(str(path)) is not None
     
 def is_dirty_or_untracked(repo):
     return repo.is_dirty() or len(repo.untracked_files)>0
     
 def get_git_commit_version(path):
 
-    if not is_git_repo(path):
+    repo = _open_repo(str(path))
+
+    if repo is None:
         return ''
 
-    repo = git.Repo(path, search_parent_directories=True)
     hash = repo.head.object.hexsha
 
     if is_dirty_or_untracked(repo):
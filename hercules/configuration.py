@@ -9,20 +9,44 @@ Date: February 24, 2021
 __all__ = []
 
 import configparser
+from functools import lru_cache
 from pathlib import Path
 
 _MODULEDIR = Path(__file__).parent.absolute()
 _CONFIGDIR = _MODULEDIR/'settings'/'config.ini'
 
 
+@lru_cache(maxsize=None)
+def get_config():
+    """Return the shared Configuration instance.
+
+    The config.ini is only parsed on first access of one of its values.
+    """
+    return Configuration()
+
+
 class Configuration:
 
     def __init__(self):
 
+        self._config_path = _CONFIGDIR
+        self._settings_cache = None
+
+    @property
+    def _settings(self):
+        # parse config.ini on first access and keep the values in a plain dict
+
+        if self._settings_cache is None:
+            self._settings_cache = self._read_settings()
+
+        return self._settings_cache
+
+    def _read_settings(self):
+
         config = configparser.ConfigParser()
 
         try:
-            with open(_CONFIGDIR) as f:
+            with open(self._config_path) as f:
                 config.read_file(f)
         except IOError:
             raise FileNotFoundError('config.ini not found!\n'
@@ -30,79 +54,84 @@ class Configuration:
                     + 'to hercules/settings/config.ini, adjust to your needs '
                     + 'and run pip install again!')
 
-        self._handle_env(config)
+        settings = self._handle_env(config)
 
-        self._locust_version = config['PACKAGE']['LOCUSTVERSION']
-        self._locust_path = config['PACKAGE']['LOCUSTPATH']
-        self._p8compute_version = config['PACKAGE']['P8COMPUTEVERSION']
-        self._p8compute_path = config['PACKAGE']['P8COMPUTEPATH']
-        self._desktop_parallel_jobs = config['USER']['DESKTOP_PARALLEL_JOBS']
+        settings['locust_version'] = config['PACKAGE']['LOCUSTVERSION']
+        settings['locust_path'] = config['PACKAGE']['LOCUSTPATH']
+        settings['p8compute_version'] = config['PACKAGE']['P8COMPUTEVERSION']
+        settings['p8compute_path'] = config['PACKAGE']['P8COMPUTEPATH']
+        settings['desktop_parallel_jobs'] = config['USER']['DESKTOP_PARALLEL_JOBS']
 
-        self._partition = config['GRACE']['JOB_PARTITION']
-        self._job_timelimit = config['GRACE']['JOB_TIMELIMIT']
-        self._job_memory = config['GRACE']['JOB_MEMORY']
-        self._job_limit = config['GRACE']['JOB_LIMIT']
+        settings['partition'] = config['GRACE']['JOB_PARTITION']
+        settings['job_timelimit'] = config['GRACE']['JOB_TIMELIMIT']
+        settings['job_memory'] = config['GRACE']['JOB_MEMORY']
+        settings['job_limit'] = config['GRACE']['JOB_LIMIT']
+
+        return settings
 
     def _handle_env(self, config):
 
-        self._env = config['USER']['ENVIRONMENT']
-        self._python_script_path = config['USER']['PYTHON_SCRIPT_DIR']
+        settings = {}
+        settings['env'] = config['USER']['ENVIRONMENT']
+        settings['python_script_path'] = config['USER']['PYTHON_SCRIPT_DIR']
 
-        if self._env == 'desktop':
-            self._container = config['DESKTOP']['CONTAINER']
-            #self._container = (config['DESKTOP']['CONTAINER']
+        if settings['env'] == 'desktop':
+            settings['container'] = config['DESKTOP']['CONTAINER']
+            #settings['container'] = (config['DESKTOP']['CONTAINER']
                                 #+ ':' + config['PACKAGE']['P8COMPUTEVERSION'])
-        elif self._env == 'grace':
-            self._container = config['GRACE']['CONTAINER']
+        elif settings['env'] == 'grace':
+            settings['container'] = config['GRACE']['CONTAINER']
         else:
-            raise ValueError((self._env
+            raise ValueError((settings['env']
                               + ' is not a valid environment setting.'
                               + ' Check settings/config.ini'))
 
+        return settings
+
     @property
     def locust_version(self):
-        return self._locust_version
+        return self._settings['locust_version']
 
     @property
     def locust_path(self):
-        return self._locust_path
+        return self._settings['locust_path']
 
     @property
     def python_script_path(self):
-        return self._python_script_path
+        return self._settings['python_script_path']
 
     @property
     def p8compute_version(self):
-        return self._p8compute_version
+        return self._settings['p8compute_version']
 
     @property
     def p8compute_path(self):
-        return self._p8compute_path
+        return self._settings['p8compute_path']
 
     @property
     def env(self):
-        return self._env
+        return self._settings['env']
 
     @property
     def container(self):
-        return self._container
+        return self._settings['container']
 
     @property
     def desktop_parallel_jobs(self):
-        return self._desktop_parallel_jobs
+        return self._settings['desktop_parallel_jobs']
 
     @property
     def partition(self):
-        return self._partition
+        return self._settings['partition']
 
     @property
     def job_timelimit(self):
-        return self._job_timelimit
+        return self._settings['job_timelimit']
 
     @property
     def job_memory(self):
-        return self._job_memory
+        return self._settings['job_memory']
 
     @property
     def job_limit(self):
-        return self._job_limit
+        return self._settings['job_limit']
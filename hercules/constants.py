@@ -10,7 +10,7 @@ __all__ = []
 
 from pathlib import Path, PurePosixPath
 
-from .configuration import Configuration
+from .configuration import get_config
 
 MODULE_DIR = Path(__file__).parent.absolute()
 HEXBUG_DIR = MODULE_DIR / 'hexbug'
@@ -28,4 +28,5 @@ LOCUST_CONFIG_NAME = 'Locust.json'
 KASS_CONFIG_NAME = 'LocustKassElectrons.xml'
 SIM_CONFIG_NAME = 'SimConfig.json'
 
-CONFIG = Configuration()
+#parsed lazily on first use
+CONFIG = get_config()
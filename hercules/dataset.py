@@ -7,27 +7,93 @@ Date: October 17, 2022
 """
 
 import numpy as np
-from scipy.interpolate import interp1d
-import dill as pickle
-from pathlib import Path
+import h5py
+import json
+import os
+from pathlib import Path, PurePath
+from functools import lru_cache
+import itertools
+from collections import deque
+import concurrent.futures as cf
 import numbers
 
 from .constants import PY_DATA_NAME
 
+_INDEX_NAME = 'index.he'
+_AXES_NAME = 'index_axes.npz'
+_KEYS_NAME = 'index_keys.npy'
+_HDF5_NAME = 'data.h5'
+_NPY_NAME = 'all_data.npy'
 
-class Constant:
+# HDF5 filter id of bitshuffle, needs a registered plugin e.g. from hdf5plugin
+_BITSHUFFLE_FILTER = 32008
+
+# number of index lookups memoized per dataset
+_INDEX_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=128)
+def _load_npy(path):
+    # memory mapped and cached by path string, repeated loads share the OS page cache.
+    # The data files are plain arrays, object arrays would need pickle and are refused.
+    return np.load(path, mmap_mode='r', allow_pickle=False)
+
+
+def _nearest_idx(ax, x):
+    # Return the index of the value in the sorted array ax that is nearest to x.
+    # Only the two neighbors of the insertion point are candidates,
+    # ties go to the lower value. Works for scalars and arrays of x.
+    if len(ax) == 1:
+        return np.zeros(np.shape(x), dtype=np.intp)
+    i = np.clip(np.searchsorted(ax, x), 1, len(ax)-1)
+    return np.where(x-ax[i-1] <= ax[i]-x, i-1, i)
+
+
+def _chunk_shape(shape, itemsize, chunk_bytes):
+    # Chunk along the first axis with roughly chunk_bytes per chunk
+    row_bytes = itemsize * int(np.prod(shape[1:]))
+    rows = max(1, min(shape[0], chunk_bytes // max(row_bytes, 1)))
+    return (rows,) + tuple(shape[1:])
+
+
+def _register_hdf5_plugins():
+    # Importing hdf5plugin registers its filters with h5py, if it is installed
+    try:
+        import hdf5plugin
+    except ImportError:
+        pass
+
+
+def _compression_args():
+    # Use bitshuffle+LZ4 if the filter is available, lzf otherwise
+    _register_hdf5_plugins()
+
+    if h5py.h5z.filter_avail(_BITSHUFFLE_FILTER):
+        return {'compression': _BITSHUFFLE_FILTER, 'compression_opts': (0, 2)}
     
-    def __init__(self, x):
-        
-        self.x = x
-        
-    def __call__(self, x):
-        return self.x
+    return {'compression': 'lzf'}
+
+
+def _json_default(obj):
+    # Convert the numpy and path values users put into the metadata for json
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, PurePath):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _round_key(params, digits=12):
+    # Normalize the numbers in a key so that float jitter maps to the same key.
+    # Rounded to significant digits, so small values keep their relative precision.
+    return tuple(float(f'{float(p):.{digits}g}') if isinstance(p, numbers.Number) else p for p in params)
 
 
 class Dataset:
     
-    _class_version = '2.0'
+    _class_version = '3.0'
     
     def __init__(self, directory, config_list, interpolate=True):
         
@@ -35,8 +101,18 @@ class Dataset:
         self._directory.mkdir(parents=True, exist_ok=True)
         self._version = self._class_version
         self._interpolate_axes = interpolate
+        self._data_layout = 'files' # one data.npy per simulation
+        self._hdf5_filter = None # compression filter of data.h5
         self._make_index(config_list)
+        self._reset_caches()
         
+    def _reset_caches(self):
+        # Open files and memoized lookups, all created lazily on first use and never persisted
+        self._hdf5_handle = None
+        self._npy_data = None
+        self._path_positions_map = None
+        self._index_cache = {}
+
     def _make_index(self, config_list):
         """Create the index dictionary.
         
@@ -51,121 +127,375 @@ class Dataset:
         self._index = {}
         self._meta_data = config_list.get_meta_data()
         self._config_data_keys = list(config_list.get_config_data_keys()) # maps a list index to a key
+        key_to_ind = {k: i for i, k in enumerate(self._config_data_keys)} # maps a key to a list index
         config_list_internal = config_list.get_internal_list()
 
-        self._initialize_axes(config_list_internal)
+        axes_types = self._initialize_axes(config_list_internal)
+
+        # one row per configuration and one column per axis
+        values = np.empty((len(config_list_internal), len(self._config_data_keys)), dtype=object)
         
         for i, sim_config in enumerate(config_list_internal):
             path = sim_config.sim_name
             config_data = sim_config.get_config_data()
 
-            for k in config_data:
-                k_ind = self._config_data_keys.index(k)
-                self._axes[k_ind][i] = config_data[k]
+            values[i, [key_to_ind[k] for k in config_data]] = list(config_data.values())
             
             self._index[tuple(config_data.values())] = path
 
-        for i in range(len(self._axes)):
-            self._axes[i] = np.sort(np.unique(self._axes[i]))
+        # np.unique returns the values already sorted
+        self._axes = [np.unique(values[:, j].astype(t)) if t is not None else np.unique(values[:, j].tolist())
+                      for j, t in enumerate(axes_types)]
+
+        self._make_keys()
         
         if self._interpolate_axes:
             self._interpolate_all()
 
+    def _make_keys(self):
+        # Keys and paths of the index as parallel containers for lookups with a tolerance
+        # and the fixed grid dimensions
+        self._n_axes = len(self._axes)
+        self._shape = tuple(len(ax) for ax in self._axes)
+        self._paths = list(self._index.values())
+
+        # the paths on the N-D grid spanned by the axes, None where there is no simulation
+        self._path_grid = np.full(self._shape, None, dtype=object)
+        self._path_grid[tuple(self._key_positions().T)] = self._paths
+
+        if all(np.issubdtype(ax.dtype, np.number) for ax in self._axes):
+            self._keys = np.asarray(list(self._index.keys()), dtype=float)
+        else:
+            self._keys = None
+
+        # rounded keys for O(1) lookups that tolerate float jitter,
+        # keys that collide after rounding are left to _lookup_close
+        rounded = {}
+        for key in self._index:
+            rounded.setdefault(_round_key(key), []).append(key)
+        self._rounded_index = {k: v[0] for k, v in rounded.items() if len(v) == 1}
+
     def _initialize_axes(self, config_list_internal):
-        self._axes = []
+        # Return the dtype of each axis or None for non-numeric axes
+        axes_types = []
         config_data0 = config_list_internal[0].get_config_data()
         for k in self._config_data_keys:
             var0 = config_data0[k]
 
             if isinstance(var0, numbers.Number):
-                self._axes.append(np.empty(len(config_list_internal), dtype=type(var0)))
+                axes_types.append(type(var0))
             else:
-                self._axes.append([i for i in range(len(config_list_internal))])
-                if self._interpolate:
+                axes_types.append(None)
+                if self._interpolate_axes:
                     print('Warning! Interpolation of axes not possible for non-numeric types! Deactivating interpolation')
                     self._interpolate_axes = False
+
+        return axes_types
         
     def _interpolate_all(self):
         
         print('Making interpolation')
 
-        self._axes_int = []
+        self._axes_sorted = [np.ascontiguousarray(ax) for ax in self._axes]
 
-        for ax in self._axes:
-            self._axes_int.append(self._interpolate(ax))
-        
-    def _interpolate(self, x):
-        
-        if len(x)>1:
-            x_int = interp1d(x, x, kind='nearest', bounds_error=None, fill_value='extrapolate')
-        else:
-            x_int = Constant(x)
-            
-        return x_int
+    def _snap_all(self, params):
+        # snap each parameter to the position of the nearest value on its axis
+        return tuple(int(_nearest_idx(ax, p)) for ax, p in zip(self._axes_sorted, params))
         
     def get_data(self, params, interpolation=True):
         
-        parameters, sim_path = self.get_path(params, interpolation=interpolation)
+        method = 'interpolated' if interpolation else 'exact'
+        parameters, sim_path = self.get_path(params, method=method)
         
         path = sim_path.relative_to(self._directory)
         
-        return parameters, self.load_sim(path)
+        return parameters, self._load_sim(path)
         
     def _load_sim(self, path):
-        return np.load(self._directory / path / PY_DATA_NAME)
+        if self._data_layout == 'hdf5':
+            return self._hdf5_file[str(path)][()]
+        if self._data_layout == 'npy':
+            return self._npy_file[self._path_positions[str(path)]]
+        # the returned array is a read-only memory map, copy it if you need to modify it
+        return _load_npy(str(self._directory / path / PY_DATA_NAME))
+
+    @property
+    def _hdf5_file(self):
+        # one handle for all simulations, the chunk cache avoids repeated decompression
+        if self._hdf5_handle is None:
+            _register_hdf5_plugins()
+
+            if self._hdf5_filter == _BITSHUFFLE_FILTER and not h5py.h5z.filter_avail(_BITSHUFFLE_FILTER):
+                raise RuntimeError('The dataset is compressed with bitshuffle! Install hdf5plugin to read it')
+
+            self._hdf5_handle = h5py.File(self._directory/_HDF5_NAME, 'r', rdcc_nbytes=4_000_000)
+
+        return self._hdf5_handle
+
+    @property
+    def _npy_file(self):
+        if self._npy_data is None:
+            self._npy_data = np.load(self._directory/_NPY_NAME, mmap_mode='r', allow_pickle=False)
+
+        return self._npy_data
+
+    @property
+    def _path_positions(self):
+        # maps a simulation path to its position on the grid
+        if self._path_positions_map is None:
+            self._path_positions_map = {str(path): tuple(row) for path, row
+                                        in zip(self._paths, self._key_positions().tolist())}
+
+        return self._path_positions_map
+
+    def _key_positions(self):
+        # Return the positions of the index keys on the axes as an integer array
+        keys = list(self._index.keys())
+        key_positions = np.empty((len(keys), self._n_axes), dtype=np.int64)
+
+        for j, column in enumerate(zip(*keys)):
+            key_positions[:, j] = np.searchsorted(self._axes[j], column)
+
+        return key_positions
+
+    def pack_hdf5(self, chunk_bytes=2**20):
+        """Pack the data of all simulations into a single HDF5 file.
+
+        Each simulation becomes a chunked and compressed HDF5 dataset in 
+        data.h5 and the dataset reads from that file from then on. 
+        Compression is bitshuffle+LZ4 if the filter is available 
+        (install hdf5plugin) and lzf otherwise. The individual data.npy 
+        files are not deleted.
+        
+        Parameters
+        ----------
+        chunk_bytes : int
+            Approximate size of a chunk in bytes (default 1 MB)
+        """
+
+        compression = _compression_args()
+
+        # close the file this dataset might still be reading from
+        if self._hdf5_handle is not None:
+            self._hdf5_handle.close()
+            self._hdf5_handle = None
+
+        # written next to data.h5 and renamed, a failed pack leaves the old file intact
+        tmp_path = self._directory/(_HDF5_NAME + '.tmp')
+
+        with h5py.File(tmp_path, 'w') as f:
+            for path in self._index.values():
+                data = np.load(self._directory / path / PY_DATA_NAME)
+
+                if data.ndim > 0:
+                    chunks = _chunk_shape(data.shape, data.dtype.itemsize, chunk_bytes)
+                    f.create_dataset(str(path), data=data, chunks=chunks, **compression)
+                else:
+                    f.create_dataset(str(path), data=data)
+
+        os.replace(tmp_path, self._directory/_HDF5_NAME)
+        self._data_layout = 'hdf5'
+        self._hdf5_filter = compression['compression']
+        self.dump()
+
+    def pack_npy(self):
+        """Pack the data of all simulations into a single memory mapped .npy file.
+
+        The data is laid out on the dataset grid in C order in all_data.npy,
+        i.e. the array has the shape dataset.shape + data shape, and the 
+        dataset reads views of that file from then on. All simulations need
+        data of the same shape and dtype. The individual data.npy files are 
+        not deleted.
+
+        Raises
+        ------
+        ValueError
+            If the simulations have data of different shape or dtype.
+        """
+
+        positions = self._key_positions()
+        first = np.load(self._directory / self._paths[0] / PY_DATA_NAME, mmap_mode='r')
+
+        all_data = np.lib.format.open_memmap(self._directory/_NPY_NAME, mode='w+',
+                                             shape=self._shape + first.shape, dtype=first.dtype)
+
+        for path, position in zip(self._paths, positions.tolist()):
+            data = np.load(self._directory / path / PY_DATA_NAME, mmap_mode='r')
+
+            if data.shape != first.shape or data.dtype != first.dtype:
+                raise ValueError(f'Data of {path} does not match the shape and dtype of {self._paths[0]}!')
+
+            all_data[tuple(position)] = data
+
+        all_data.flush()
+        del all_data
+
+        self._npy_data = None
+        self._data_layout = 'npy'
+        self.dump()
         
     def get_path(self, params, method='interpolated'):
 
-        if len(params) != len(self._axes):
-            raise ValueError(f'params has len {len(params)} but dataset expects len {len(self._axes)}!')
+        if len(params) != self._n_axes:
+            raise ValueError(f'params has len {len(params)} but dataset expects len {self._n_axes}!')
 
         if method == 'interpolated':
-            if not self._interpolate:
+            if not self._interpolate_axes:
                 raise ValueError('Dataset is not interpolated!') 
-            key = [self._axes_int[i](params[i]).item() for i in range(len(params))]
+            return self._index_lookup(self._snap_all(params))
         elif method == 'index':
-            key = [self._axes[i][params[i]] for i in range(len(params))]
+            return self._index_lookup(tuple(params))
         elif method == 'exact':
             key = params
         else:
             raise ValueError("method can only take values 'interpolated', 'index' or 'exact'!")
 
-        parameters = tuple(key)
+        return self._lookup(tuple(key))
+
+    def get_paths(self, params, method='interpolated'):
+        """Return the parameters and paths for many lookups at once.
+
+        Equivalent to calling get_path for every row of params, but the 
+        snapping to the axes is done with one vectorized search per axis.
+
+        Parameters
+        ----------
+        params : array_like
+            Parameters with shape (N, number of axes), one lookup per row
+        method : str
+            'interpolated', 'index' or 'exact', see get_path
+
+        Returns
+        -------
+        list
+            List of (parameters, path) tuples
+        """
+
+        if method == 'exact':
+            keys = [tuple(p) for p in params]
+        else:
+            params = np.asarray(params)
+
+            if params.ndim != 2 or params.shape[1] != self._n_axes:
+                raise ValueError(f'params has shape {params.shape} but dataset expects (N, {self._n_axes})!')
+
+            if method == 'interpolated':
+                if not self._interpolate_axes:
+                    raise ValueError('Dataset is not interpolated!')
+                positions = tuple(_nearest_idx(ax, params[:, j]) for j, ax in enumerate(self._axes_sorted))
+            elif method == 'index':
+                positions = tuple(params.T)
+            else:
+                raise ValueError("method can only take values 'interpolated', 'index' or 'exact'!")
+
+            # a single fancy index into the grid resolves all lookups
+            sim_paths = self._path_grid[positions]
+            keys = zip(*[ax[position].tolist() for ax, position in zip(self._axes, positions)])
+            result = []
+
+            for key, sim_path in zip(keys, sim_paths):
+                if sim_path is None:
+                    raise KeyError(f'{key} is not part of the dataset!')
+                result.append((key, self._directory / sim_path))
+
+            return result
+
+        for key in keys:
+            if len(key) != self._n_axes:
+                raise ValueError(f'params has len {len(key)} but dataset expects len {self._n_axes}!')
+
+        return [self._lookup(key) for key in keys]
+
+    def _lookup(self, parameters):
 
         sim_path = self._index.get(parameters) # self._index[parameters]
 
         if sim_path is None:
-            raise KeyError(f'{parameters} is not part of the dataset!')
+            # floats can differ by a few ULPs from the stored keys
+            key = self._rounded_index.get(_round_key(parameters))
+            if key is not None:
+                parameters, sim_path = key, self._index[key]
+            else:
+                parameters, sim_path = self._lookup_close(parameters)
         
         return parameters, self._directory / sim_path
+
+    def _lookup_close(self, parameters):
+
+        if self._keys is not None:
+            mask = np.all(np.isclose(self._keys, np.asarray(parameters, dtype=float), 
+                                     rtol=1e-12, atol=1e-12), axis=1)
+            if mask.any():
+                i = np.argmax(mask)
+                return tuple(self._keys[i].tolist()), self._paths[i]
+
+        raise KeyError(f'{parameters} is not part of the dataset!')
+
+    def _get_path_by_index(self, index):
+
+        parameters = tuple(self._axes[i][index[i]].item() for i in range(self._n_axes))
+        sim_path = self._path_grid[index]
+
+        if sim_path is None:
+            raise KeyError(f'{parameters} is not part of the dataset!')
+
+        return parameters, self._directory / sim_path
+
+    def _index_lookup(self, index):
+        # memoized version of _get_path_by_index keyed on the index tuple,
+        # the oldest entry is dropped once the cache is full
+        result = self._index_cache.get(index)
+
+        if result is None:
+            result = self._get_path_by_index(index)
+
+            if len(self._index_cache) >= _INDEX_CACHE_SIZE:
+                del self._index_cache[next(iter(self._index_cache))]
+            self._index_cache[index] = result
+
+        return result
     
     def __iter__(self):
-        self._it_index = tuple(0 for i in range(len(self.shape)))
-        self._it_stop = False
+        self._it = itertools.product(*[range(n) for n in self._shape])
         return self
 
     def __next__(self):
+        return self._index_lookup(next(self._it))
+    
+    def iter_prefetch(self, loader, prefetch=4):
+        """Iterate over the dataset and load the data of each entry in the background.
 
-        if not self._it_stop:
-
-            new_index = list(self._it_index)
+        Works like iterating over the dataset itself, but instead of the path
+        the result of loader(path) is returned. Up to prefetch loads are 
+        running in a thread pool ahead of the caller, which overlaps file 
+        I/O with whatever the caller does with the data.
 
-            for i in reversed(range(len(self._it_index))):
-                new_index[i] += 1
-                if new_index[i] == self.shape[i]:
-                    new_index[i] = 0
-                else:
-                    break
+        Parameters
+        ----------
+        loader : callable
+            Function that takes the path of a simulation and returns its data,
+            e.g. lambda path: LocustP3File(path / 'simulation.egg')
+        prefetch : int
+            Number of loads in flight (default 4)
+
+        Yields
+        ------
+        tuple
+            The parameters and the loaded data
+        """
 
-            old_index = self._it_index
-            self._it_index = tuple(new_index)
+        queue = deque()
 
-            if self._it_index == tuple(0 for i in range(len(self.shape))):
-                self._it_stop = True
+        with cf.ThreadPoolExecutor(max_workers=prefetch) as executor:
+            for param, path in self:
+                queue.append((param, executor.submit(loader, path)))
+                if len(queue) >= prefetch:
+                    param_done, future = queue.popleft()
+                    yield param_done, future.result()
 
-            return self.get_path(old_index, method='index')
-        else:
-            raise StopIteration
+            while queue:
+                param_done, future = queue.popleft()
+                yield param_done, future.result()
     
     @property
     def config_data_keys(self):
@@ -177,15 +507,35 @@ class Dataset:
     
     @property
     def shape(self):
-        return tuple(len(ax) for ax in self._axes)
+        return self._shape
     
     @property
     def meta_data(self):
         return self._meta_data
         
     def dump(self):
-        with open(self._directory/'index.he', "wb") as f:
-            pickle.dump(self, f, protocol=4)
+        # The index is stored column-wise: the axes as arrays, the keys as 
+        # integer positions on the axes and the paths together with the 
+        # metadata as json. Nothing is pickled.
+        # The json is encoded before anything is written, so metadata it
+        # cannot store fails without touching the files.
+        index = json.dumps({'version': self._version,
+                            'meta-data': self._meta_data,
+                            'config-data-keys': self._config_data_keys,
+                            'interpolate': self._interpolate_axes,
+                            'data-layout': self._data_layout,
+                            'hdf5-filter': self._hdf5_filter,
+                            'paths': [str(p) for p in self._index.values()]},
+                           default=_json_default)
+
+        np.savez(self._directory/_AXES_NAME, *self._axes)
+        np.save(self._directory/_KEYS_NAME, self._key_positions())
+
+        # written next to the index and renamed, there is never a partial index
+        index_tmp = self._directory/(_INDEX_NAME + '.tmp')
+        with open(index_tmp, "w", encoding='utf-8') as f:
+            f.write(index)
+        os.replace(index_tmp, self._directory/_INDEX_NAME)
 
         with open(self._directory/'info.txt', "w") as f:
             f.write(f'Hercules dataset version {self._version}\n')
@@ -205,19 +555,44 @@ class Dataset:
     def load(cls, path):
         path_p = Path(path)
 
-        with open(path_p/'index.he', "rb") as f:
-            instance = pickle.load(f)
+        try:
+            with open(path_p/_INDEX_NAME, "r", encoding='utf-8') as f:
+                index = json.load(f)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            # datasets up to version 2.0 pickled the entire instance
+            raise RuntimeError(f'{path_p} is a pickled hercules dataset of version 2.0 or older! To open it you need a hercules release older than 3.0')
 
-        if type(instance) is not cls:
+        if not isinstance(index, dict) or 'version' not in index:
             raise RuntimeError('Path does not point to a hercules dataset')
         
-        if '_version' not in dir(instance):
-            instance_version = '1.0'
-        else:
-            instance_version = instance._version
+        instance_version = index['version']
         
         if instance_version != cls._class_version:
             raise RuntimeError(f'Tried to load a version {instance_version} hercules dataset with version {cls._class_version}! To open this file you need an older hercules release')
 
+        with np.load(path_p/_AXES_NAME, allow_pickle=False) as axes_file:
+            axes = [axes_file[f'arr_{i}'] for i in range(len(axes_file.files))]
+
+        key_positions = np.load(path_p/_KEYS_NAME, allow_pickle=False)
+
+        instance = cls.__new__(cls)
         instance._directory = path_p
-        return instance
\ No newline at end of file
+        instance._version = instance_version
+        instance._meta_data = index['meta-data']
+        instance._config_data_keys = index['config-data-keys']
+        instance._interpolate_axes = index['interpolate']
+        instance._data_layout = index['data-layout']
+        instance._hdf5_filter = index.get('hdf5-filter')
+        instance._axes = axes
+
+        axes_values = [ax.tolist() for ax in axes]
+        instance._index = {tuple(axes_values[j][k] for j, k in enumerate(row)): path
+                           for row, path in zip(key_positions.tolist(), index['paths'])}
+
+        instance._make_keys()
+        instance._reset_caches()
+
+        if instance._interpolate_axes:
+            instance._interpolate_all()
+
+        return instance
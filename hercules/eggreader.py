@@ -7,47 +7,122 @@ Date: February 22, 2021
 
 __all__ = ['LocustP3File']
 
+from functools import lru_cache
+import concurrent.futures as cf
+import os
+
 import numpy as np
 import h5py
 from scipy.fft import fft, fftshift, fftfreq
 
+# DFT slices are transformed in blocks of about this size in quick_load_fft_stream,
+# so the mean subtraction, FFT and shift run on data that stays in cache
+_DFT_BLOCK_BYTES = 2**20
+
+
+@lru_cache(maxsize=None)
+def _fftw_builders():
+    """
+    Helper function that returns pyfftw.builders, None if pyfftw is not installed.
+    Resolved on first use, the global state of pyfftw is left alone.
+    """
+    try:
+        import pyfftw.builders
+    except ImportError:
+        return None
+    return pyfftw.builders
+
+
+def _scipy_fft(data):
+    # Orthonormal FFT on the last axis with scipy, on all cores and overwriting data
+    return fft(data, workers=-1, overwrite_x=True, norm='ortho')
+
 
-def _apply_DFT(data, dft_window):
+def _make_fft():
     """
-    Helper function that takes FFT of data on the last axis
+    Helper function that returns a function fft(data) taking the orthonormal FFT of data on the last axis,
+    data is overwritten. With pyfftw the FFTW plans are measured once per shape and kept by the
+    returned function, measured plans pay off for a fixed DFT window. Falls back to scipy otherwise.
     """
+    builders = _fftw_builders()
+    if builders is None:
+        return _scipy_fft
 
-    mean = np.mean(data, axis=-1, keepdims=True)
+    plans = {}
 
-    normalization = np.sqrt(1 / dft_window)
-    # By default uses the last axis
-    data_freq = fft(data - mean)
-    data_freq = fftshift(data_freq, axes=-1)
-    data_freq = data_freq * normalization
+    def fftw(data):
+        key = (data.shape, data.dtype, data.strides)
+        if key not in plans:
+            plans[key] = builders.fft(data, overwrite_input=True, planner_effort='FFTW_MEASURE',
+                                      threads=os.cpu_count(), norm='ortho')
+        # the plan copies data into its aligned input array if needed
+        # and returns its output array, which the next call overwrites
+        return plans[key](data)
 
-    return data_freq
+    return fftw
 
 
-def _to_complex(data):
+def _apply_DFT(data, out=None, fft=_scipy_fft):
     """
-    Convert to complex
+    Helper function that takes the orthonormal FFT of data on the last axis.
+    data is used as work space and overwritten.
+    If out is given the shifted DFT is written into it instead of a new array.
+    fft: function computing the transform, see _make_fft
     """
-    return data[::2] + 1j * data[1::2]
+
+    data -= np.mean(data, axis=-1, keepdims=True)
+
+    # norm='ortho' applies the 1/sqrt(dft_window) normalization inside the transform
+    data_freq = fft(data)
+    if out is None:
+        return fftshift(data_freq, axes=-1)
+
+    # shift while copying into out, saves the copy made by fftshift
+    shift = data_freq.shape[-1] // 2
+    out[..., shift:] = data_freq[..., :-shift or None]
+    out[..., :shift] = data_freq[..., data_freq.shape[-1] - shift:]
+    return out
+
+
+@lru_cache(maxsize=None)
+def _fill_acquisition_kernel():
+    """
+    Helper function that returns the compiled acquisition kernel, None if numba is not installed.
+    Resolved on first use since importing numba is slow.
+    """
+    from ._kernels import fill_acquisition
+    return fill_acquisition
+
+
+@lru_cache(maxsize=32)
+def _freq_axis(dft_window, acq_rate):
+    """
+    Helper function that returns the shifted frequency axis of a DFT window,
+    shared between calls and therefore read-only
+    """
+    frequency = fftshift(fftfreq(dft_window, d=1 / acq_rate))
+    frequency.setflags(write=False)
+    return frequency
 
 
 class LocustP3File:
 
     _int_max = {8: 255, 16: 65535}
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, cache_bytes: int = 64 * 1024**2):
+        """
+        Open an egg file for reading.
+        cache_bytes: size of the HDF5 chunk cache, defaults to 64 MiB.
+        Lower it on memory constrained nodes.
+        """
 
-        self._input_file = h5py.File(file_name, 'r')
+        self._input_file = h5py.File(file_name, 'r', rdcc_nbytes=cache_bytes, rdcc_nslots=521)
         self._get_attributes()
 
     def _get_attributes(self):
         ### Attrs see https://monarch.readthedocs.io/en/latest/EggStandard.v3.2.0.html#file-structure
         # A dict for file attrs
-        self._file_attrs = self._input_file.attrs
+        self._file_attrs = dict(self._input_file.attrs)
 
         # A dict of dict for stream attrs (includes all streams)
         self._streams_attrs = self._get_streams_attrs()
@@ -61,6 +136,12 @@ class LocustP3File:
         # Channel -> Stream mapping
         self._channel_streams = self._file_attrs['channel_streams']
 
+        # Acquisition dataset handles by stream, opened and checked on first load
+        self._acquisitions = {}
+
+        # Frequency axis and DFT function by (dft_window, stream), see prepare_fft
+        self._fft_plans = {}
+
     def _get_streams_attrs(self):
         """
         Get all streams attrs
@@ -68,8 +149,8 @@ class LocustP3File:
         h5file = self._input_file
         streams_attr = {}
         for (key, item) in h5file['streams'].items():
-            att = item.attrs
-            streams_attr[key] = att
+            # plain dict, later lookups do not go back to HDF5
+            streams_attr[key] = dict(item.attrs)
         return streams_attr
 
     def _get_channels_attrs(self):
@@ -79,63 +160,121 @@ class LocustP3File:
         h5file = self._input_file
         channels_attr = {}
         for (key, item) in h5file['channels'].items():
-            att = item.attrs
-            channels_attr[key] = att
+            # plain dict, later lookups do not go back to HDF5
+            channels_attr[key] = dict(item.attrs)
         return channels_attr
 
-    def _convert_to_voltage(self, data: np.ndarray, channel: int):
+    def _voltage_scale(self, channel: int):
         """
-        Convert complex data from digitizer unit to volts, specific by channel
+        Scale and offset converting digitizer units of a channel to volts, None if the data is already analog
         """
-        if not np.issubdtype(data.dtype, np.complexfloating):
-            raise ValueError("Data is not complex.")
         attr = self.get_channel_attrs(channel)
-        bit_depth = attr['bit_depth']
-        voltage_range = attr['voltage_range']
-        voltage_offset = attr['voltage_offset']
-        
+
         if attr['data_format'] == 2:
         #data is already analog
-            return data
+            return None
+        return attr['voltage_range'] / self._int_max[attr['bit_depth']], attr['voltage_offset']
+
+    def _get_acquisitions(self, s, n_acq):
+        # Reuse the dataset handles of a stream instead of walking the group tree on every load.
+        # The record counts are checked once here, the reads rely on them being equal
+        if s.name not in self._acquisitions:
+            acqs = [s['acquisitions']['%s' % i] for i in range(n_acq)]
+            n_records = np.fromiter((acq.attrs['n_records'] for acq in acqs), dtype=np.int64, count=n_acq)
+            if np.any(n_records != n_records[:1]):
+                raise RuntimeError("Acquisitions have different numbers of records")
+            self._acquisitions[s.name] = acqs
+        return self._acquisitions[s.name]
+
+    @staticmethod
+    def _fill_acquisition(raw, ch_format, scales, out):
+        # Deinterleave the raw records of an acquisition into out with shape
+        # (n_records, n_channels, record_size) and convert to volts in the same pass,
+        # without full size temporaries
+        n_records, n_ch = out.shape[:2]
+        if ch_format == 1:
+            pairs = raw.reshape(n_records, n_ch, -1, 2)
         else:
-            return data / self._int_max[bit_depth] * voltage_range + voltage_offset + 1j * voltage_offset
+            pairs = raw.reshape(n_records, -1, n_ch, 2).transpose(0, 2, 1, 3)
+
+        for k, scale in enumerate(scales):
+            if scale is None and pairs.dtype == out.real.dtype:
+                # analog pairs in the target precision are complex numbers already
+                np.copyto(out[:, k], pairs[:, k].view(out.dtype)[..., 0])
+                continue
+            for part, target in ((0, out[:, k].real), (1, out[:, k].imag)):
+                if scale is None:
+                    np.copyto(target, pairs[:, k, :, part])
+                else:
+                    np.multiply(pairs[:, k, :, part], scale[0], out=target)
+                    target += scale[1]
 
-    def _read_ts(self, s, attr):
+    def _acquisition_reader(self, s, attr, dtype=None):
         """
-        Helper method that returns a channel list and raw time series in np.array of shape:
-        (n_acquisitions, n_records, n_channels, record_size)
+        Helper method that returns the channel list, the shape (n_acquisitions, n_records, n_channels, record_size)
+        and dtype of the stream in volts and a function read(i, out=None) filling out with acquisition i
+        dtype: complex dtype of the result, by default the precision of the raw samples.
         """
 
         n_acq = attr['n_acquisitions']
         channels = attr['channels']
         ch_format = attr['channel_format']
-        data = []
-        for i in range(n_acq):
-            acq = s['acquisitions']['%s' % i]
-            n_records = acq.attrs['n_records']
-            temp = []
-            for j in range(n_records):
-                temp_data = _to_complex(acq[j])
-                if ch_format == 1:
-                    temp.append(temp_data.reshape((len(channels), -1)))
-                elif ch_format == 0:
-                    n_ch = len(channels)
-                    for k in range(n_ch):
-                        temp_data_copy = []
-                        temp_data_copy.append(temp_data[k::n_ch])
-                    temp.append(temp_data_copy)
-                else:
-                    raise RuntimeError("Invalid channel format")
-            data.append(temp)
-        data = np.asarray_chkfinite(data)
-        return channels, data
-
-    def load_ts_stream(self, stream: int = 0):
+        if ch_format not in (0, 1):
+            raise RuntimeError("Invalid channel format")
+
+        acqs = self._get_acquisitions(s, n_acq)
+        n_records = acqs[0].attrs['n_records']
+        record_size = acqs[0].shape[-1] // (2 * len(channels))
+        scales = [self._voltage_scale(ch) for ch in channels]
+
+        if dtype is None:
+            # same precision as combining the raw samples with 1j
+            dtype = np.result_type(acqs[0].dtype, 1j)
+        check_finite = np.issubdtype(acqs[0].dtype, np.floating)
+        kernel = _fill_acquisition_kernel()
+        if kernel is not None:
+            # analog channels go through the kernel unscaled
+            scale = np.array([1. if sc is None else sc[0] for sc in scales])
+            offset = np.array([0. if sc is None else sc[1] for sc in scales])
+
+        # raw buffer shared by all reads, the callers read the acquisitions one
+        # at a time (serially or in a single prefetch thread) and raw is fully
+        # converted into out before the next read
+        raw_buffer = [np.empty(acqs[0].shape, dtype=acqs[0].dtype)]
+
+        def read(i, out=None):
+            acq = acqs[i]
+            if out is None:
+                out = np.empty((n_records, len(channels), record_size), dtype=dtype)
+            raw = raw_buffer[0]
+            if raw.shape != acq.shape or raw.dtype != acq.dtype:
+                raw = raw_buffer[0] = np.empty(acq.shape, dtype=acq.dtype)
+            # the whole acquisition in one read, skipping h5py's slicing machinery
+            acq.read_direct(raw)
+            if check_finite:
+                np.asarray_chkfinite(raw)
+            if kernel is not None:
+                kernel(raw, ch_format == 1, scale, offset, out)
+            else:
+                self._fill_acquisition(raw, ch_format, scales, out)
+            return out
+
+        return channels, (n_acq, n_records, len(channels), record_size), dtype, read
+
+    def _read_ts(self, s, attr, dtype=None):
         """
-        Load the time series in a stream by stream basis. Only a single stream is allowed.
-        The dataset is structured as (dict of arrays):
-        {Channel #: [Acquisition0: [Record0, Record1, ...], Acquisition1: [...], ...], Channel #: [...], ...}
+        Helper method that returns a channel list and the time series in volts as np.array of shape:
+        (n_acquisitions, n_records, n_channels, record_size)
+        dtype: complex dtype of the result, by default the precision of the raw samples.
         """
+        channels, shape, dtype, read = self._acquisition_reader(s, attr, dtype)
+        data = np.empty(shape, dtype=dtype)
+        for i in range(shape[0]):
+            read(i, data[i])
+        return channels, data
+
+    def _get_stream(self, stream):
+        # The stream group and its attributes
         try:
             s = self._input_file['streams']["stream{}".format(stream)]
             attr = self.get_stream_attrs(stream)
@@ -144,87 +283,139 @@ class LocustP3File:
         except Exception as e:
             print(e)
             raise
+        return s, attr
+
+    def _load_stream(self, stream, dtype=None):
+        # Read a whole stream as returned by _read_ts
+        s, attr = self._get_stream(stream)
+        return self._read_ts(s, attr, dtype)
+
+    def _iter_stream(self, stream, dtype=None):
+        # Returns the channels, the stream shape and dtype and an iterator over the acquisitions.
+        # The next acquisition is read on a background thread while the caller
+        # works on the current one, h5py and the conversion release the GIL.
+        s, attr = self._get_stream(stream)
+        channels, shape, dtype, read = self._acquisition_reader(s, attr, dtype)
+
+        def acquisitions():
+            with cf.ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(read, 0) if shape[0] else None
+                for i in range(shape[0]):
+                    data = future.result()
+                    if i + 1 < shape[0]:
+                        future = executor.submit(read, i + 1)
+                    yield data
+
+        return channels, shape, dtype, acquisitions()
 
-        channels, data = self._read_ts(s, attr)
+    def load_ts_stream(self, stream: int = 0):
+        """
+        Load the time series in a stream by stream basis. Only a single stream is allowed.
+        The dataset is structured as (dict of arrays):
+        {Channel #: [Acquisition0: [Record0, Record1, ...], Acquisition1: [...], ...], Channel #: [...], ...}
+        """
+        channels, data = self._load_stream(stream)
         result = {}
-        for ch in channels:
-            data_ts = self._convert_to_voltage(data[:, :, ch, :], ch)
-            result[ch] = np.ascontiguousarray(data_ts)
+        for k, ch in enumerate(channels):
+            result[ch] = np.ascontiguousarray(data[:, :, k, :])
 
         return result
 
-    def quick_load_ts_stream(self, stream: int = 0):
+    def quick_load_ts_stream(self, stream: int = 0, dtype=None):
         """
         Load the time series in default format (numpy array) with shape:
         (n_acquisitions, n_channels, n_records * record_size)
+        dtype: complex dtype of the result, by default the precision of the raw samples.
         """
-        try:
-            s = self._input_file['streams']["stream{}".format(stream)]
-            attr = self.get_stream_attrs(stream)
-        except KeyError as kerr:
-            print(kerr)
-        except Exception as e:
-            print(e)
-            raise
-
-        channels, data = self._read_ts(s, attr)
+        channels, data = self._load_stream(stream, dtype)
         # transpose axis 1 and 2 and concatenate all records
         data = np.swapaxes(data, 1, 2)
         data = np.reshape(data, data.shape[:2] + (-1,))
-        for ch in channels:
-            data[:, ch, :] = self._convert_to_voltage(data[:, ch, :], ch)
         data = np.ascontiguousarray(data)
 
         return data
 
-    def load_fft_stream(self, dft_window: int = 4096, stream: int = 0):
+    def load_fft_stream(self, dft_window: int = 4096, stream: int = 0, dtype=np.complex64):
         """
         Load the FFT of the timeseries.
         dft_window: sample size for each DFT slice, defaults to 4096.
+        dtype: complex dtype of the time series and FFT, defaults to complex64.
+        Pass np.complex128 for double precision.
+        The returned frequency axis is shared between calls and read-only.
         Structure is the same as that of the timeseries.
         """
-        ts = self.load_ts_stream(stream=stream)
-        result = {}
+        # the FFT of an acquisition overlaps with reading the next one
+        channels, shape, dtype, acquisitions = self._iter_stream(stream, dtype)
+        n_acq, n_records, n_ch, record_size = shape
+        n_slices = int(record_size / dft_window)
+        # channel first, so every channel's result is a contiguous block of one array
+        spectra = np.empty((n_ch, n_acq, n_records, n_slices, dft_window), dtype=dtype)
+        result = {ch: spectra[k] for k, ch in enumerate(channels)}
 
-        attr = self.get_stream_attrs(stream)
-        # Rate from MHz -> Hz
-        acq_rate = attr['acquisition_rate'] * 1e6
-        channels = attr['channels']
+        frequency, do_fft = self.prepare_fft(dft_window, stream)
 
-        for ch in channels:
-            ts_ch = ts[ch]
-            n_slices = int(ts_ch.shape[-1] / dft_window)
-            ts_sliced = ts_ch[:, :, :n_slices * dft_window].reshape(
-                (ts_ch.shape[0], ts_ch.shape[1], n_slices, -1))
+        for i, ts in enumerate(acquisitions):
+            # slice all channels straight out of the acquisition, no contiguous copies needed
+            ts_sliced = ts[:, :, :n_slices * dft_window].reshape((n_records, n_ch, n_slices, -1))
 
-            # Apply DFT to sliced ts and return DFT in the original shape
+            # Apply DFT to all channels in one threaded batch, written straight into the results
             # freq is a single array since acq_rate is the same for all data in the stream
-            data_freq = _apply_DFT(ts_sliced, dft_window)
-            result[ch] = np.ascontiguousarray(data_freq)
+            do_fft(ts_sliced, out=spectra[:, i].swapaxes(0, 1))
 
-        frequency = fftshift(fftfreq(dft_window, d=1 / acq_rate))
         return frequency, result
 
-    def quick_load_fft_stream(self, dft_window: int = 4096, stream: int = 0):
+    def quick_load_fft_stream(self, dft_window: int = 4096, stream: int = 0, dtype=np.complex64):
         """
         Load FFT in default format:
         Note n_slices = int(n_records * record_size / dft_window)
         (n_acquisitions, n_channels, n_slices, FFT for each slice)
+        dtype: complex dtype of the time series and FFT, defaults to complex64.
+        Pass np.complex128 for double precision.
+        The returned frequency axis is shared between calls and read-only.
         """
-        ts = self.quick_load_ts_stream(stream)
-        attr = self.get_stream_attrs(stream)
-        # Rate from MHz -> Hz
-        acq_rate = attr['acquisition_rate'] * 1e6
-        n_slices = int(ts.shape[-1] / dft_window)
-        # Discard extra data points
-        ts_sliced = ts[:, :, :n_slices * dft_window].reshape(
-            (ts.shape[0], ts.shape[1], n_slices, -1))
-        data_freq = _apply_DFT(ts_sliced, dft_window)
-        data_freq = np.ascontiguousarray(data_freq)
-
-        frequency = fftshift(fftfreq(dft_window, d=1 / acq_rate))
+        # the FFT of an acquisition overlaps with reading the next one
+        channels, shape, dtype, acquisitions = self._iter_stream(stream, dtype)
+        n_acq, n_records, n_ch, record_size = shape
+        n_slices = int(n_records * record_size / dft_window)
+        data_freq = np.empty((n_acq, n_ch, n_slices, dft_window), dtype=dtype)
+
+        frequency, do_fft = self.prepare_fft(dft_window, stream)
+        block = max(1, _DFT_BLOCK_BYTES // (dft_window * data_freq.itemsize))
+
+        for i, ts in enumerate(acquisitions):
+            # concatenate all records of a channel
+            ts = np.swapaxes(ts, 0, 1).reshape((n_ch, -1))
+            # Discard extra data points
+            ts_sliced = ts[:, :n_slices * dft_window].reshape((n_ch, n_slices, -1))
+            for k in range(n_ch):
+                for start in range(0, n_slices, block):
+                    do_fft(ts_sliced[k, start:start + block], out=data_freq[i, k, start:start + block])
+
         return frequency, data_freq
 
+    def prepare_fft(self, dft_window: int = 4096, stream: int = 0):
+        """
+        Prepare the DFT of a stream for a fixed window size, cached per dft_window and stream.
+        Returns the frequency axis and a function do_fft(ts_sliced, out=None) that takes time series
+        sliced to shape (..., dft_window) and returns their shifted and normalized DFT,
+        written into out if given. ts_sliced is used as work space and overwritten.
+        """
+        key = (dft_window, stream)
+        if key not in self._fft_plans:
+            attr = self.get_stream_attrs(stream)
+            # Rate from MHz -> Hz
+            frequency = _freq_axis(dft_window, attr['acquisition_rate'] * 1e6)
+            fft = _make_fft()
+
+            def do_fft(ts_sliced, out=None):
+                if ts_sliced.shape[-1] != dft_window:
+                    raise ValueError("Last axis has to match the DFT window of {}".format(dft_window))
+                return _apply_DFT(ts_sliced, out, fft)
+
+            self._fft_plans[key] = frequency, do_fft
+
+        return self._fft_plans[key]
+
     @property
     def n_channels(self):
         return self._n_channels
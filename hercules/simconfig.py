@@ -8,17 +8,30 @@ Date: March 10, 2021
 
 __all__ = ['SimConfig']
 
+import os
+import posixpath
 import time
 import json
 import re
-from copy import deepcopy
+from functools import lru_cache
 from math import sqrt, atan2
 from pathlib import Path
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 from .constants import (HEXBUG_DIR, HEXBUG_DIR_CONTAINER, OUTPUT_DIR_CONTAINER,
                         LOCUST_CONFIG_NAME_P2, KASS_CONFIG_NAME_P2,
                         LOCUST_CONFIG_NAME_P3, KASS_CONFIG_NAME_P3)
 
+# string versions of the directories, joining strings is cheaper than joining
+# paths and the container paths are posix paths on any host
+_HEXBUG_DIR = str(HEXBUG_DIR)
+_HEXBUG_DIR_CONTAINER = str(HEXBUG_DIR_CONTAINER)
+_OUTPUT_DIR_CONTAINER = str(OUTPUT_DIR_CONTAINER)
+
 def _get_rand_seed():
     
     # Return a seed based on the current time.
@@ -29,10 +42,8 @@ def _get_rand_seed():
     #     The random seed
     
     t = int( time.time() * 1000.0 )
-    seed = ((t & 0xff000000) >> 24) +\
-             ((t & 0x00ff0000) >>  8) +\
-             ((t & 0x0000ff00) <<  8) +\
-             ((t & 0x000000ff) << 24)
+    # reverse the byte order of the lowest 4 bytes
+    seed = int.from_bytes((t & 0xffffffff).to_bytes(4, 'big'), 'little')
              
     return seed
  
@@ -40,36 +51,187 @@ def _get_json_from_file(locust_file):
     
     # Return the json dictionary from a path to a json file.
     # 
+    # The dictionary is cached as long as the modification time of the file
+    # does not change and is shared by all callers, it must not be modified.
+    # 
+    # Parameters
+    # ----------
+    # locust_file : str 
+    #     The path to the json file
+    # 
+    # Returns
+    # -------
+    # dict
+    #     The dictionary with the contents of the json file
+    
+    locust_file = str(locust_file)
+    return _read_json_file(locust_file, os.stat(locust_file).st_mtime_ns)
+
+@lru_cache(maxsize=8)
+def _read_json_file(locust_file, mtime):
+    
+    # Return the json dictionary from a path to a json file, cached by path
+    # and modification time.
+    # 
     # Parameters
     # ----------
     # locust_file : str 
     #     The path to the json file
+    # mtime : int
+    #     The modification time of the file, only used as part of the cache key
     # 
     # Returns
     # -------
     # dict
     #     The dictionary with the contents of the json file
     
-    with open(locust_file, 'r') as read_file:
-        return json.load(read_file)
+    with open(locust_file, 'rb') as read_file:
+        return _json_loads(read_file.read())
         
 def _get_xml_from_file(xml_file):
     
     # Return the contents of an xml file.
     # 
+    # The content is cached as long as the modification time of the file does
+    # not change, so a parameter sweep reads its template only once.
+    # 
+    # Parameters
+    # ----------
+    # xml_file : str 
+    #     The path to the xml file
+    # 
+    # Returns
+    # -------
+    # str
+    #     The string content of the xml file
+    
+    xml_file = str(xml_file)
+    return _read_xml_file(xml_file, os.stat(xml_file).st_mtime_ns)
+
+@lru_cache(maxsize=8)
+def _read_xml_file(xml_file, mtime):
+    
+    # Return the contents of an xml file, cached by path and modification time.
+    # 
     # Parameters
     # ----------
     # xml_file : str 
     #     The path to the xml file
+    # mtime : int
+    #     The modification time of the file, only used as part of the cache key
     # 
     # Returns
     # -------
     # str
     #     The string content of the xml file
     
-    with open(xml_file) as conf:
+    with open(xml_file, encoding='utf-8') as conf:
         return conf.read()
 
+@lru_cache(maxsize=None)
+def _combined_regex(complex_expressions, simple_expressions):
+    
+    # Return one compiled regex matching any of the given expressions.
+    # 
+    # The common start of all expressions (usually '<') is factored out, the
+    # regex engine then only tries the alternatives where it occurs instead of
+    # at every position of the string.
+    # 
+    # Parameters
+    # ----------
+    # complex_expressions : tuple
+    #     The min/max value expressions
+    # simple_expressions : tuple
+    #     The simple value expressions
+    # 
+    # Returns
+    # -------
+    # re.Pattern
+    #     The alternation of all expressions, the match of the i-th expression
+    #     (complex ones first) is the group named 'ri'
+    
+    value = KassConfig._match_all_regex.pattern
+    prefix = os.path.commonprefix(complex_expressions + simple_expressions)
+    n = len(prefix)
+    
+    patterns = ([re.escape(expression[n:]) + value + re.escape(KassConfig._val_max_expression) + value
+                    for expression in complex_expressions]
+                + [re.escape(expression[n:]) + value for expression in simple_expressions])
+    
+    return re.compile(re.escape(prefix) + '(?:'
+                      + '|'.join('(?P<r{}>{})'.format(i, pattern) for i, pattern in enumerate(patterns))
+                      + ')')
+
+@lru_cache(maxsize=8)
+def _parse_template(xml, complex_expressions, simple_expressions):
+    
+    # Split a template at the values of the given expressions.
+    # 
+    # All expressions are found in a single scan of the template, which also
+    # yields their default values.
+    # 
+    # Parameters
+    # ----------
+    # xml : str 
+    #     The content of the template
+    # complex_expressions : tuple
+    #     The min/max value expressions
+    # simple_expressions : tuple
+    #     The simple value expressions
+    # 
+    # Returns
+    # -------
+    # fragments : tuple
+    #     The utf-8 encoded text between the matched expressions, one more
+    #     than there are slots
+    # slots : tuple
+    #     For each match the index of its expression, complex ones first
+    # values : dict
+    #     The values of the first match of each expression found in the
+    #     template, a tuple (min, max) for the complex ones and (val,) for
+    #     the simple ones
+    
+    regex = _combined_regex(complex_expressions, simple_expressions)
+    expressions = complex_expressions + simple_expressions
+    n_complex = len(complex_expressions)
+    
+    fragments = []
+    slots = []
+    values = {}
+    start = 0
+    for match in regex.finditer(xml):
+        fragments.append(xml[start:match.start()])
+        # the outer groups are named r0, r1, ... in the order of the expressions
+        # and are directly followed by the value groups of the expression
+        i = int(match.lastgroup[1:])
+        g = regex.groupindex[match.lastgroup]
+        values.setdefault(expressions[i], match.groups()[g:g + (2 if i < n_complex else 1)])
+        slots.append(i)
+        start = match.end()
+    fragments.append(xml[start:])
+    
+    # encoded once here, a config is then joined and written as bytes
+    return tuple(fragment.encode('utf-8') for fragment in fragments), tuple(slots), values
+
+@lru_cache(maxsize=None)
+def _accepted_kass_keys(simple_keys, complex_keys):
+    
+    # Return the keys accepted by a KassConfig with the given expression keys.
+    # 
+    # Parameters
+    # ----------
+    # simple_keys : tuple
+    #     The keys of the simple expressions
+    # complex_keys : tuple
+    #     The keys of the min/max expressions, ending with 'min'
+    # 
+    # Returns
+    # -------
+    # tuple
+    #     The simple keys, the min keys and the corresponding max keys
+    
+    return simple_keys + complex_keys + tuple(key[:-3]+'max' for key in complex_keys)
+
 def _write_xml_file(output_path, xml):
     
     # Write an xml file.
@@ -78,11 +240,41 @@ def _write_xml_file(output_path, xml):
     # ----------
     # output_path : str 
     #     The path to xml file which is to be created
-    # xml : str
-    #     The content for the xml file
+    # xml : str or bytes
+    #     The content for the xml file, str is written utf-8 encoded
     
-    with open(output_path, 'w') as new_conf:
-        new_conf.write(xml) 
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    
+    # binary mode skips the text layer, the content is written in one go
+    with open(output_path, 'wb') as new_conf:
+        new_conf.write(xml)
+    
+def _write_json_file(output_path, content, indent=None, default=None):
+    
+    # Write a json file.
+    # 
+    # Without indentation the compact separators are used and the whole text
+    # is encoded in one go, which lets json use its C encoder.
+    # 
+    # Parameters
+    # ----------
+    # output_path : str 
+    #     The path to json file which is to be created
+    # content : dict
+    #     The content for the json file
+    # indent : int, optional
+    #     The indentation, None for a compact file (default None)
+    # default : callable, optional
+    #     Passed on to json.dumps for objects json cannot serialize
+    
+    if indent is None:
+        text = json.dumps(content, separators=(',', ':'), default=default)
+    else:
+        text = json.dumps(content, indent=indent, default=default)
+    
+    with open(output_path, 'w') as outfile:
+        outfile.write(text)
     
 class KassConfig:
     
@@ -97,7 +289,7 @@ class KassConfig:
     #https://www.regular-expressions.info/floatingpoint.html
     #_float_regex = re.compile('"([-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?)"') #not used
     #_int_regex = re.compile('"(\d+)"') #not used
-    _match_all_regex = re.compile('"(.+?)"')
+    _match_all_regex = re.compile('"([^"]+)"')
     
     _config_path_expression = '<external_define name="config_path" value='
     
@@ -117,14 +309,15 @@ class KassConfig:
                                    'config_path': _config_path_expression}
     
     # these dictionaries define the accepted parameters and should also contain some documentation
+    # the entries of the simple parameters also hold the type of their value
     _expression_dict_simple = {'seed_kass': [_seed_expression,
-                                            'int -- The seed used for Kassiopeia generators'],
+                                            'int -- The seed used for Kassiopeia generators', int],
                                't_max': [_t_max_expression,
-                                            'float -- The maximum time length of the electron trjactory'],
+                                            'float -- The maximum time length of the electron trjactory', float],
                                'geometry': [_geometry_expression,
-                                            'str -- The file name for the trap geometry. The file has to be placed in hercules/hexbug/PHASE/Trap'],
+                                            'str -- The file name for the trap geometry. The file has to be placed in hercules/hexbug/PHASE/Trap', str],
                                'energy': [_energy_expression,
-                                            'float -- Initial electron kinetic energy']}
+                                            'float -- Initial electron kinetic energy', float]}
                        
     _expression_dict_complex = {'x_min': [_x_val_expression,
                                             'float -- Paired with x_max. Bounds for uniform generator of initial electron x position. For full control use one value for both'],
@@ -135,6 +328,10 @@ class KassConfig:
                                'theta_min': [_theta_val_expression,
                                             'float -- Paired with y_max. Bounds for uniform generator of initial electron y position. For full control use one value for both'] }
     
+    # the accepted keys as a set, extended for instances with unknown arguments
+    _accepted_keys = frozenset(_accepted_kass_keys(tuple(_expression_dict_simple),
+                                                   tuple(_expression_dict_complex)))
+    
     def __init__(self,
                 phase = 'Phase3',
                 kass_file_name = None,
@@ -188,9 +385,12 @@ class KassConfig:
     
     def _add_unknown_args_translation(self, unknown_args_translation):
         # Add the translation of unknown arguments to _expression_dict_simple
-        self._expression_dict_simple = self._expression_dict_simple.copy()#prevent overriding the class level dict
-        for key in unknown_args_translation:
-            self._expression_dict_simple[key] = [unknown_args_translation[key], '']
+        # the class level dict is only copied if there is something to add
+        if unknown_args_translation:
+            self._expression_dict_simple = {**self._expression_dict_simple, #prevent overriding the class level dict
+                                            **{key: [unknown_args_translation[key], '', None]
+                                               for key in unknown_args_translation}}
+            self._accepted_keys = self._accepted_keys | frozenset(unknown_args_translation)
         
         
     def _read_config_dict(self, config_dict):
@@ -201,12 +401,10 @@ class KassConfig:
         # arguments. To prevent filling the internal dictionary with anything
         # this method adds only the accepted keys.
         
-        accepted_keys = self.get_accepted_keys()
-        
         #internal config dictionary
         self._config_dict = {k:config_dict[k] 
                             for k 
-                            in set(config_dict).intersection(accepted_keys)}
+                            in config_dict.keys() & self._accepted_keys}
     
     def _handle_phase(self, phase, file_name):
         # Read the phase parameter and take appropriate actions according input
@@ -226,13 +424,13 @@ class KassConfig:
         
         if allowed:
             
-            self._config_path = HEXBUG_DIR_CONTAINER/phase
+            self._config_path = posixpath.join(_HEXBUG_DIR_CONTAINER, phase)
             
             if file_name is None:
                 file_name = (KASS_CONFIG_NAME_P3 if phase=='Phase3' else
                                 KASS_CONFIG_NAME_P2)
             
-            self._file_name = HEXBUG_DIR/phase/file_name
+            self._file_name = os.path.join(_HEXBUG_DIR, phase, file_name)
             
         else:
             raise ValueError('Only "Phase2" or "Phase3" are supported')
@@ -250,13 +448,30 @@ class KassConfig:
         if 'seed_kass' not in self._config_dict:
             self._config_dict['seed_kass'] = _get_rand_seed()
     
+    def _get_template_parts(self):
+        # Return the fragments, slots and values of the template
+        #
+        # See _parse_template, the expressions are in the same order as the
+        # replacements of _get_replacements.
+        
+        complex_expressions = tuple(dict.fromkeys(
+            entry[0] for entry in self._expression_dict_complex.values()))
+        simple_expressions = tuple(dict.fromkeys(
+            [entry[0] for entry in self._expression_dict_simple.values()]
+            + [self._expression_dict_constants['output_path'],
+               self._expression_dict_constants['config_path']]))
+        
+        return _parse_template(self._xml, complex_expressions, simple_expressions)
+    
     def _add_defaults(self):
         # Add both types of default parameters to the internal configuration
         
-        self._add_complex_defaults()
-        self._add_simple_defaults()
+        _, _, values = self._get_template_parts()
+        
+        self._add_complex_defaults(values)
+        self._add_simple_defaults(values)
                         
-    def _get_min_max_val(self, expression, string):
+    def _get_min_max_val(self, expression, values):
         # Extract a min and a max value from a string expression
         #
         # The function is used to extract the default values 
@@ -269,8 +484,8 @@ class KassConfig:
         # expression : str
         #       A string like "<x_uniform value_min=" used to match the whole
         #       expression above
-        # string : str
-        #       the content of the xml file as a string
+        # values : dict
+        #       the values of the expressions found in the template
         #
         # Returns
         # -------
@@ -279,15 +494,14 @@ class KassConfig:
         # max_val
         #       the maximum value it found
         
-        regex = expression+self._match_all_regex.pattern\
-            +self._val_max_expression+self._match_all_regex.pattern
-        result = re.findall(regex, string)
-        min_val = result[0][0]
-        max_val = result[0][1]
+        result = values.get(expression)
+        if result is None:
+            raise ValueError('Expression {} not found in the template'.format(expression))
+        min_val, max_val = result
         
         return min_val, max_val
         
-    def _get_val(self, expression, string):
+    def _get_val(self, expression, values):
         # Extract a value from a string expression
         #
         # The function is used to extract the default values 
@@ -300,21 +514,22 @@ class KassConfig:
         # expression : str
         #       A string like "<external_define name="seed" value=" used to 
         #       match the whole expression above
-        # string : str
-        #       the content of the xml file as a string
+        # values : dict
+        #       the values of the expressions found in the template
         #
         # Returns
         # -------
         # val
         #       the value it found
         
-        regex = expression+self._match_all_regex.pattern
-        result = re.findall(regex, string)
-        val = result[0]
+        result = values.get(expression)
+        if result is None:
+            raise ValueError('Expression {} not found in the template'.format(expression))
+        val, = result
         
         return val
         
-    def _add_simple_defaults(self):
+    def _add_simple_defaults(self, values):
         # Add default values to the internal config dict
         #
         # The default values are taken from the template config file.
@@ -323,14 +538,19 @@ class KassConfig:
         for key in self._expression_dict_simple:
             #if self._config_dict[key] is None:
             if key not in self._config_dict:
-                val = self._get_val(self._expression_dict_simple[key][0], self._xml)
-                try:
-                    val_f = float(val)
-                except ValueError:
-                    val_f = val
+                val = self._get_val(self._expression_dict_simple[key][0], values)
+                value_type = self._expression_dict_simple[key][2]
+                if value_type is not None:
+                    val_f = value_type(val)
+                else:
+                    # the type of unknown parameters is not known
+                    try:
+                        val_f = float(val)
+                    except ValueError:
+                        val_f = val
                 self._config_dict[key] = val_f
                 
-    def _add_complex_defaults(self):
+    def _add_complex_defaults(self, values):
         # Add default values to the internal config dict
         #
         # The default values are taken from the template config file.
@@ -340,15 +560,13 @@ class KassConfig:
             #if self._config_dict[key] is None:
             if key not in self._config_dict:
                 minVal, maxVal =( 
-                    self._get_min_max_val(self._expression_dict_complex[key][0], self._xml))
+                    self._get_min_max_val(self._expression_dict_complex[key][0], values))
                 self._config_dict[key] = float(minVal)
                 self._config_dict[key[:-3]+'max'] = float(maxVal)
      
-    def _replace_simple_val(self, expression, value, string):
-        # Replace a value in a Kassiopeia config
+    def _simple_replacement(self, expression, value):
+        # Return the text replacing a simple value in a Kassiopeia config
         #
-        # The function is used to replace the default values 
-        # for simple variables in the Kassiopeia config.
         # The expression in the config files looks like this 
         # '<external_define name="seed" value=X>'
         #
@@ -359,22 +577,17 @@ class KassConfig:
         #       match the whole expression above
         # value: 
         #       The value to insert
-        # string : str
-        #       the content of the xml file as a string
         #
         # Returns
         # -------
         # str
-        #       the string with the replaced value
+        #       the expression with the new value
         
-        return re.sub( expression + self._match_all_regex.pattern,
-                       expression +'"'+str(value)+'"', string)
+        return '%s"%s"' % (expression, value)
                        
-    def _replace_complex_val(self, expression, val_min, val_max, string):
-        # Replace a min and a max value in a Kassiopeia config
+    def _complex_replacement(self, expression, val_min, val_max):
+        # Return the text replacing a min and a max value in a Kassiopeia config
         #
-        # The function is used to replace the default values 
-        # for variables that describe a range in the Kassiopeia config.
         # The expression in the config files looks like this 
         # <x_uniform value_min=a value_max=b>.
         #
@@ -387,73 +600,13 @@ class KassConfig:
         #       The minimum value to insert
         # val_max:
         #       The maximum value to insert
-        # string : str
-        #       the content of the xml file as a string
-        #
-        # Returns
-        # -------
-        # str
-        #       the string with the replaced values
-        
-        return re.sub( ( expression 
-                        + self._match_all_regex.pattern
-                        + self._val_max_expression
-                        + self._match_all_regex.pattern),
-                        ( expression
-                        + '"'+str(val_min)+'"'
-                        + self._val_max_expression
-                        + '"'+str(val_max)+'"'), string)
-    
-    def _replace_simple(self, key, string):
-        # Replace a value in a Kassiopeia config
-        #
-        # The function is used to replace the default values 
-        # for simple variables in the Kassiopeia config.
-        # Value and expression are taken from the internal config and 
-        # expression dictionaries via the key that is passed.
-        #
-        # Parameters
-        # ----------
-        # key : str
-        #       A key of the internal dictionaries
-        # string : str
-        #       the content of the xml file as a string
-        #
-        # Returns
-        # -------
-        # str
-        #       the string with the replaced value
-    
-        expression = self._expression_dict_simple[key][0]
-        val = self._config_dict[key]
-        
-        return self._replace_simple_val(expression, val, string)
-        
-    def _replace_complex(self, key, string):
-        # Replace a min and a max value in a Kassiopeia config
-        #
-        # The function is used to replace the default values 
-        # for variables that describe a range in the Kassiopeia config.
-        # Values and expression are taken from the internal config and 
-        # expression dictionaries via the key that is passed.
-        #
-        # Parameters
-        # ----------
-        # key : str
-        #       A key of the internal dictionaries
-        # string : str
-        #       the content of the xml file as a string
         #
         # Returns
         # -------
         # str
-        #       the string with the replaced value
+        #       the expression with the new values
         
-        expression = self._expression_dict_complex[key][0]
-        val_min = self._config_dict[key]
-        val_max = self._config_dict[key[:-3]+'max']
-        
-        return self._replace_complex_val(expression, val_min, val_max, string)
+        return '%s"%s"%s"%s"' % (expression, val_min, self._val_max_expression, val_max)
         
     def _prefix(self, key, value):
         # Add a string to the value of a string entry in the internal config
@@ -465,33 +618,68 @@ class KassConfig:
         
         self._prefix('geometry', '[config_path]/Trap/')
         
-    def _replace_constants(self, string):
-        # Replace parts of a Kassiopeia config that are not part of the 
-        # internal config dictionary since they are the same for any configuration
+    def _get_replacements(self):
+        # Return the replacements for all parts of a Kassiopeia config
+        #
+        # Two dicts from expression to replacement text, the first one for
+        # the min/max expressions and the second one for the simple expressions.
+        # The latter includes the constants, which are not part of the internal
+        # config dictionary since they are the same for any configuration.
         
-        string = self._replace_simple_val(
-                                self._expression_dict_constants['output_path'], 
-                                str(OUTPUT_DIR_CONTAINER), string)
-        string = self._replace_simple_val(
-                                self._expression_dict_constants['config_path'], 
-                                str(self._config_path), string)
-                                
-        return string
+        complex_replacements = {}
+        for key in self._expression_dict_complex:
+            complex_replacements[self._expression_dict_complex[key][0]] = (
+                self._complex_replacement(self._expression_dict_complex[key][0],
+                                          self._config_dict[key],
+                                          self._config_dict[key[:-3]+'max']))
+        
+        simple_replacements = {}
+        for key in self._expression_dict_simple:
+            simple_replacements[self._expression_dict_simple[key][0]] = (
+                self._simple_replacement(self._expression_dict_simple[key][0],
+                                         self._config_dict[key]))
+        
+        simple_replacements[self._expression_dict_constants['output_path']] = (
+            self._simple_replacement(self._expression_dict_constants['output_path'],
+                                     _OUTPUT_DIR_CONTAINER))
+        simple_replacements[self._expression_dict_constants['config_path']] = (
+            self._simple_replacement(self._expression_dict_constants['config_path'],
+                                     self._config_path))
+        
+        return complex_replacements, simple_replacements
                         
     def _replace_all(self):
         # Replace all parts of a Kassiopeia config
+        #
+        # The template is split once at all expressions, a config is then
+        # built by joining the fixed fragments with the replacements, both utf-8
+        # encoded so the result can be written without another conversion.
         
-        xml = self._xml
+        complex_replacements, simple_replacements = self._get_replacements()
+        fragments, slots, _ = self._get_template_parts()
+        replacements = [replacement.encode('utf-8') for replacement
+                        in [*complex_replacements.values(), *simple_replacements.values()]]
         
-        for key in self._expression_dict_complex:
-            xml = self._replace_complex(key, xml)
-            
-        for key in self._expression_dict_simple:
-            xml = self._replace_simple(key, xml)
-            
-        xml = self._replace_constants(xml)
-            
-        return xml
+        parts = [fragments[0]]
+        for slot, fragment in zip(slots, fragments[1:]):
+            parts.append(replacements[slot])
+            parts.append(fragment)
+        
+        return b''.join(parts)
+        
+    @classmethod
+    def _from_dict(cls, phase, config_dict):
+        # Return a KassConfig with a complete internal config dict
+        #
+        # Used to restore a saved configuration, only the phase dependent
+        # parts are set up since no defaults have to be read.
+        
+        instance = cls.__new__(cls)
+        instance._config_dict = config_dict
+        instance._handle_phase(phase, None)
+        instance._xml = _get_xml_from_file(instance._file_name)
+        
+        return instance
 
     # -------- public part --------
             
@@ -509,13 +697,8 @@ class KassConfig:
             list of the accepted keys
         """
         
-        keys = list(self._expression_dict_simple.keys())
-        keys = keys + list(self._expression_dict_complex.keys())
-        
-        for key in self._expression_dict_complex:
-            keys.append(key[:-3]+'max')
-            
-        return keys
+        return list(_accepted_kass_keys(tuple(self._expression_dict_simple),
+                                        tuple(self._expression_dict_complex)))
         
     
     @classmethod
@@ -542,7 +725,32 @@ class KassConfig:
         xml = self._replace_all()
         _write_xml_file(output_path, xml)
    
-def _set_dict_2d(key_dict, key_to_var_dict, arg_dict):
+def _flatten_key_dicts(key_dict, key_to_var_dict):
+    # Return the Locust key structure as a flat table
+    #
+    # Parameters
+    # ----------
+    # key_dict : dict
+    #       Dictionary with lists of keys as values. The keys of the dictionary
+    #       itself are the first level Locust keys. Their values are lists
+    #       with the corresponding second level keys.
+    # key_to_var_dict : dict
+    #       Dictionary that maps Locust keys to variable names. Necessary
+    #       since Locust keys use dashes, which are not allowed in python
+    #       variable names.
+    #
+    # Returns
+    # -------
+    # tuple
+    #       (first level key, second level key, variable name) for all second
+    #       level keys that have a variable
+    
+    return tuple((key, sub_key, key_to_var_dict[sub_key][0])
+                 for key in key_dict
+                 for sub_key in key_dict[key]
+                 if key_to_var_dict.get(sub_key))
+
+def _set_dict_2d(key_dict, key_table, arg_dict):
     # Creates a nested dictionary for the Locust config
     #
     # The function is used to create a nested dictionary in the correct
@@ -555,10 +763,8 @@ def _set_dict_2d(key_dict, key_to_var_dict, arg_dict):
     #       Dictionary with lists of keys as values. The keys of the dictionary
     #       itself are the first level Locust keys. Their values are lists
     #       with the corresponding second level keys.
-    # key_to_var_dict : dict
-    #       Dictionary that maps Locust keys to variable names. Necessary
-    #       since Locust keys use dashes, which are not allowed in python
-    #       variable names.
+    # key_table : tuple
+    #       The flat key table of key_dict as returned by _flatten_key_dicts
     # arg_dict : dict
     #       Dictionary that maps the python variables to their values. This
     #       dictionary will be taken from the **kwargs in the Locust __init__
@@ -569,15 +775,11 @@ def _set_dict_2d(key_dict, key_to_var_dict, arg_dict):
     # dict
     #       the final nested dictionary
     
-    output = {}
-    for key in key_dict:
-        output[key] = {}
-        for sub_key in key_dict[key]:
-            var = key_to_var_dict.get(sub_key)
-            if var:
-                val = arg_dict.get(var[0])
-                if val is not None:
-                    output[key][sub_key] = val
+    output = {key: {} for key in key_dict}
+    for key, sub_key, var in key_table:
+        val = arg_dict.get(var)
+        if val is not None:
+            output[key][sub_key] = val
                 
     return output
 
@@ -737,6 +939,12 @@ class LocustConfig:
                         _center_to_antenna_key: ['center_to_antenna',
                                             'float -- Distance of waveguide center to antenna in m. Phase 2 specific ']}
     
+    # the two dicts above as a flat table, rebuilt for instances with unknown arguments
+    _key_table = _flatten_key_dicts(_key_dict, _key_to_var_dict)
+    
+    # the accepted keys as a set, extended for instances with unknown arguments
+    _accepted_keys = frozenset(val[0] for val in _key_to_var_dict.values())
+    
     def __init__(self,                
                 phase = 'Phase3',
                 locust_file_name = None,
@@ -772,7 +980,7 @@ class LocustConfig:
         
         self._add_unknown_args_translation(unknown_args_translation)
 
-        self._config_dict = _set_dict_2d(self._key_dict, self._key_to_var_dict, 
+        self._config_dict = _set_dict_2d(self._key_dict, self._key_table, 
                                             kwargs)
         self._config_dict.pop(self._generators_key)
                      
@@ -790,13 +998,20 @@ class LocustConfig:
     
     def _add_unknown_args_translation(self, unknown_args_translation):
         # Add the translation of unknown arguments to _expression_dict_simple 
-        self._key_to_var_dict = deepcopy(self._key_to_var_dict) #prevent overriding the class level dict
-        self._key_dict = deepcopy(self._key_dict)
+        # the class level dicts are only copied if there is something to add
+        if not unknown_args_translation:
+            return
+        #prevent overriding the class level dicts, only the lists of second
+        #level keys are modified so they are the only values that are copied
+        self._key_to_var_dict = dict(self._key_to_var_dict)
+        self._key_dict = {key: list(sub_keys) for key, sub_keys in self._key_dict.items()}
         for key in unknown_args_translation:
             key_0 = unknown_args_translation[key][0]
             key_1 = unknown_args_translation[key][1]
             self._key_to_var_dict[key_1] = [key, '']
             self._key_dict[key_0].append(key_1)
+        self._key_table = _flatten_key_dicts(self._key_dict, self._key_to_var_dict)
+        self._accepted_keys = self._accepted_keys | frozenset(unknown_args_translation)
             
     
     def _handle_phase(self, phase, file_name):
@@ -818,20 +1033,20 @@ class LocustConfig:
         
         if allowed:
             
-            self._config_path = HEXBUG_DIR_CONTAINER/phase
+            self._config_path = posixpath.join(_HEXBUG_DIR_CONTAINER, phase)
             
             if file_name is None:
                 file_name = (LOCUST_CONFIG_NAME_P3 if phase=='Phase3' else
                                 LOCUST_CONFIG_NAME_P2)
             
-            self._file_name = HEXBUG_DIR/phase/file_name
+            self._file_name = os.path.join(_HEXBUG_DIR, phase, file_name)
             
             self._signal_key = (self._array_signal_key if phase=='Phase3' else 
                                     self._kass_signal_key)
             
             if phase=='Phase2':
                 self._set(self._signal_key, self._pitchangle_filename_key, 
-                        str(OUTPUT_DIR_CONTAINER / self._pitchangle_filename))
+                        posixpath.join(_OUTPUT_DIR_CONTAINER, self._pitchangle_filename))
         else:
             raise ValueError('Only "Phase2" or "Phase3" are supported')
 
@@ -840,9 +1055,7 @@ class LocustConfig:
         # Set a value in the nested internal config dictionary by its two keys
         
         if value is not None:
-            if not key0 in self._config_dict:
-                self._config_dict[key0] = {}
-            self._config_dict[key0][key1] = value
+            self._config_dict.setdefault(key0, {})[key1] = value
             
     def _prefix(self, key0, key1, value):
         # Add a string to the value of a string entry in the internal config
@@ -853,7 +1066,7 @@ class LocustConfig:
             orig = sub_dict.get(key1)
             
             if orig:
-                self._config_dict[key0][key1] = value + orig.split('/')[-1]
+                sub_dict[key1] = value + orig.split('/')[-1]
         
             
     def _finalize(self, template_config):
@@ -864,8 +1077,8 @@ class LocustConfig:
         
         self._add_defaults(template_config)
         self._handle_noise()
-        self._set(self._digit_key, self._v_offset_key, 
-                    -self._config_dict[self._digit_key][self._v_range_key]/2)
+        digitizer = self._config_dict[self._digit_key]
+        digitizer[self._v_offset_key] = -digitizer[self._v_range_key]/2
         self._adjust_paths()
         
     def _add_defaults(self, template_config):
@@ -875,14 +1088,19 @@ class LocustConfig:
         # the template file and filling in keys that are missing in the internal
         # dict.
                     
-        for key in template_config:
+        for key, template_sub in template_config.items():
             #get value from config template if it was not set
-            if key not in self._config_dict:
-                self._config_dict[key] = template_config[key]
+            sub = self._config_dict.get(key)
+            if sub is None:
+                # the template is cached and shared, the internal dict gets
+                # its own copy of the containers that are modified later on
+                if isinstance(template_sub, (dict, list)):
+                    template_sub = template_sub.copy()
+                self._config_dict[key] = template_sub
             else:
-                for sub_key in template_config[key]:
-                    if sub_key not in self._config_dict[key]:
-                        self._config_dict[key][sub_key] = template_config[key][sub_key]
+                # the values that were set stay first, as in the output so far
+                for sub_key, val in template_sub.items():
+                    sub.setdefault(sub_key, val)
                        
     def _handle_noise(self):
         # React to the noise related inputs
@@ -894,26 +1112,44 @@ class LocustConfig:
         # makes sure that only one of the two possible noise keywords goes into
         # the final config file. 
         
-        if self._noise_key in self._config_dict:
+        noise = self._config_dict.get(self._noise_key)
+        
+        if noise is not None:
+            
+            has_psd = self._noise_floor_psd_key in noise
+            has_temperature = self._noise_temperature_key in noise
 
-            if (self._noise_floor_psd_key or self._noise_temperature_key) in self._config_dict[self._noise_key]:
+            if has_psd or has_temperature:
                 self._config_dict[self._generators_key].insert(-1, self._noise_key)
 
-            if (self._noise_floor_psd_key and self._noise_temperature_key) in self._config_dict[self._noise_key]:
+            if has_psd and has_temperature:
                 #prefer noise temperature over noise psd
-                self._config_dict[self._noise_key].pop(self._noise_floor_psd_key)
+                noise.pop(self._noise_floor_psd_key)
 
-            if self._random_seed_key not in self._config_dict[self._noise_key]:
-                self._set(self._noise_key, self._random_seed_key, _get_rand_seed())
+            if self._random_seed_key not in noise:
+                noise[self._random_seed_key] = _get_rand_seed()
                 
     def _adjust_paths(self):
         # Correct the paths in the internal config where necessary
         
         self._prefix(self._sim_key, self._egg_filename_key, 
-                        str(OUTPUT_DIR_CONTAINER) + '/')
+                        _OUTPUT_DIR_CONTAINER + '/')
                         
         self._prefix(self._signal_key, self._tf_receiver_filename_key, 
-                    str(self._config_path/'TransferFunctions')+'/')
+                    posixpath.join(self._config_path, 'TransferFunctions') + '/')
+        
+    @classmethod
+    def _from_dict(cls, phase, config_dict):
+        # Return a LocustConfig with a complete internal config dict
+        #
+        # Used to restore a saved configuration, only the phase dependent
+        # parts are set up since no template has to be read.
+        
+        instance = cls.__new__(cls)
+        instance._config_dict = config_dict
+        instance._handle_phase(phase, None)
+        
+        return instance
     
     # -------- public part --------
     
@@ -935,7 +1171,7 @@ class LocustConfig:
         """
         name = path.name
         self._set(self._signal_key, self._xml_filename_key, 
-                    str(OUTPUT_DIR_CONTAINER / name))
+                    posixpath.join(_OUTPUT_DIR_CONTAINER, name))
                     
                     
     def get_accepted_keys(self):
@@ -950,17 +1186,19 @@ class LocustConfig:
         return [val[0] for val in vals]
                     
                     
-    def make_config_file(self, output_path):
+    def make_config_file(self, output_path, indent=None):
         """Create a final Locust config file from the internal config.
         
         Parameters
         ----------
         output_path : str
             the path to output config file
+        indent : int, optional
+            the indentation of the json file, None for a compact file
+            since it is only read by Locust (default None)
         """
         
-        with open(output_path, 'w') as outFile:
-            json.dump(self._config_dict, outFile, indent=2)
+        _write_json_file(output_path, self._config_dict, indent)
     
     @classmethod
     def print_keyword_documentation(cls):
@@ -1055,7 +1293,7 @@ class SimConfig:
     def _get_unknown_parameters(self, kwargs):
         # Return a set with unknown parameters
         #
-        # Gets the list of accepted keys of the KassConfig and the LocustConfig.
+        # Uses the sets of accepted keys of the KassConfig and the LocustConfig.
         # The set is created from any keys in the input that is not part of any of
         # the two.
         #
@@ -1064,10 +1302,8 @@ class SimConfig:
         # kwargs : dict
         #       dictionary of keyword arguments
         
-        accepted_parameters = ( self._kass_config.get_accepted_keys() 
-                                + self._locust_config.get_accepted_keys() )
-                                
-        return set(kwargs.keys()).difference(accepted_parameters)
+        return (kwargs.keys() - self._kass_config._accepted_keys
+                              - self._locust_config._accepted_keys)
         
     def _trigger_unknown_parameter_warnings(self, kwargs):
         # Print warnings for keyword arguments that are unknown to KassConfig/LocustConfig
@@ -1089,15 +1325,23 @@ class SimConfig:
     def sim_name(self, sim_name):
         self._sim_name = sim_name
     
-    def to_json(self, file_name):
-        """Write a json file with the entire simulation configuration."""
+    def to_json(self, file_name, indent=2):
+        """Write a json file with the entire simulation configuration.
+        
+        Parameters
+        ----------
+        file_name : str
+            the path to the json file
+        indent : int, optional
+            the indentation of the json file, None for a compact file
+            that is faster to write (default 2)
+        """
         
-        with open(file_name, 'w') as outfile:
-            json.dump({ 'sim-name': self._sim_name,
-                        'phase' : self._phase,
-                        'kass-config': self._kass_config, 
-                        'locust-config': self._locust_config}, outfile, 
-                        indent=2, default=lambda x: x.config_dict)
+        _write_json_file(file_name, { 'sim-name': self._sim_name,
+                                      'phase' : self._phase,
+                                      'kass-config': self._kass_config, 
+                                      'locust-config': self._locust_config}, 
+                         indent, default=lambda x: x.config_dict)
  
                             
     def to_dict(self):
@@ -1133,11 +1377,15 @@ class SimConfig:
             
             phase = config['phase']
             
-            instance = cls(phase=phase)
+            # the saved configs are complete, building them from the
+            # templates first would only be thrown away
+            instance = cls.__new__(cls)
+            instance._phase = phase
+            instance._extra_meta_data = {}
             instance.sim_name = config['sim-name']
             
-            instance._locust_config._config_dict = config['locust-config']
-            instance._kass_config._config_dict = config['kass-config']
+            instance._locust_config = LocustConfig._from_dict(phase, config['locust-config'])
+            instance._kass_config = KassConfig._from_dict(phase, config['kass-config'])
             
         return instance
     
@@ -1217,31 +1465,34 @@ class SimConfig:
     def get_config_data(self):
         
         config_data = {}
+        
+        kass_config = self._kass_config._config_dict
 
-        x_min = self._kass_config._config_dict['x_min']
-        y_min = self._kass_config._config_dict['y_min']
-        z_min = self._kass_config._config_dict['z_min']
-        pitch_min = self._kass_config._config_dict['theta_min']
+        x_min = kass_config['x_min']
+        y_min = kass_config['y_min']
+        z_min = kass_config['z_min']
+        pitch_min = kass_config['theta_min']
 
-        x_max = self._kass_config._config_dict['x_max']
-        y_max = self._kass_config._config_dict['y_max']
-        z_max = self._kass_config._config_dict['z_max']
-        pitch_max = self._kass_config._config_dict['theta_max']
+        x_max = kass_config['x_max']
+        y_max = kass_config['y_max']
+        z_max = kass_config['z_max']
+        pitch_max = kass_config['theta_max']
 
-        energy = self._kass_config._config_dict['energy']
+        energy = kass_config['energy']
         
         r_min = sqrt(x_min**2 + y_min**2)
         phi_min = atan2(y_min, x_min)
 
-        r_max = sqrt(x_max**2 + y_max**2)
-        phi_max = atan2(y_max, x_max)
-
         if x_min==x_max and y_min==y_max and z_min==z_max and pitch_min==pitch_max:
             config_data['r'] = r_min
             config_data['phi'] = phi_min
             config_data['z'] = z_min
             config_data['pitch'] = pitch_min
         else:
+            # the upper bounds are only needed for a range
+            r_max = sqrt(x_max**2 + y_max**2)
+            phi_max = atan2(y_max, x_max)
+            
             config_data['r_min'] = r_min
             config_data['phi_min'] = phi_min
             config_data['z_min'] = z_min
@@ -1304,14 +1555,22 @@ class SimpleSimConfig:
     def sim_name(self, sim_name):
         self._sim_name = sim_name
     
-    def to_json(self, file_name):
-        """Write a json file with the entire simulation configuration."""
+    def to_json(self, file_name, indent=2):
+        """Write a json file with the entire simulation configuration.
+        
+        Parameters
+        ----------
+        file_name : str
+            the path to the json file
+        indent : int, optional
+            the indentation of the json file, None for a compact file
+            that is faster to write (default 2)
+        """
         
-        with open(file_name, 'w') as outfile:
-            json.dump({ 'sim-name': self._sim_name,
-                        'meta-data': self._meta_data, 
-                        'config-data': self._config_data}, outfile, 
-                        indent=2)#, default=lambda x: x.config_dict)
+        _write_json_file(file_name, { 'sim-name': self._sim_name,
+                                      'meta-data': self._meta_data, 
+                                      'config-data': self._config_data}, 
+                         indent)
  
                             
     def to_dict(self):
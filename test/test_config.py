@@ -100,6 +100,16 @@ class SimConfigTest(unittest.TestCase):
         self.config.add_meta_data(additional_meta_data)
         self.assertTrue(self.config.get_meta_data()==expected)
 
+    def test_noise_temperature(self):
+
+        config = SimConfig(n_channels=3, noise_temperature=10.0)
+        locust_config = config._locust_config.config_dict
+        noise = locust_config['gaussian-noise']
+
+        self.assertEqual(locust_config['generators'].count('gaussian-noise'), 1)
+        self.assertEqual(noise['noise-temperature'], 10.0)
+        self.assertTrue('noise-floor-psd' not in noise)
+
 class SimpleSimConfigTest(unittest.TestCase):
 
     def setUp(self) -> None:
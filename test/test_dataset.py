@@ -12,6 +12,11 @@ from hercules.constants import CONFIG
 from pathlib import Path
 import unittest
 import numpy as np
+import h5py
+import json
+import pickle
+import gc
+import weakref
 import shutil
 
 module_dir = Path(__file__).parent.absolute()
@@ -65,11 +70,37 @@ class DatasetTest(unittest.TestCase):
 
         self.assertTrue(expected_result_1==self.d.get_path([100, 100, 100], method='interpolated'))
         self.assertTrue(expected_result_2==self.d.get_path([1., 3., 5.], method='exact'))
+        self.assertTrue(expected_result_2==self.d.get_path([1.+1e-14, 3., 5.], method='exact'))
         self.assertTrue(expected_result_3==self.d.get_path([4, 0, 1], method='index'))
+        self.assertEqual(repr(self.d.get_path([100, 100, 100])[0]), '(9, 3.0, 6)')
 
         with self.assertRaises(ValueError) as cm:
             self.d.get_path([4, 0, 1], method='inde')
 
+    def test_get_path_small_values(self) -> None:
+
+        clist = ConfigList()
+        for x in [1e-10, 1.]:
+            clist.add_config(SimpleSimConfig(x=x))
+        d = Dataset(test_path, clist)
+
+        self.assertTrue(d.get_path([1e-10*(1+1e-14)], method='exact')[0] == (1e-10,))
+
+        with self.assertRaises(KeyError) as cm:
+            d.get_path([3e-10], method='exact')
+
+    def test_get_paths(self) -> None:
+
+        params = [[100, 100, 100], [1., 3., 5.], [4.2, 2.9, 6.4]]
+        expected_result = [self.d.get_path(p, method='interpolated') for p in params]
+
+        self.assertTrue(expected_result==self.d.get_paths(params, method='interpolated'))
+        self.assertTrue(expected_result[1:2]==self.d.get_paths(params[1:2], method='exact'))
+        self.assertTrue([self.d.get_path([4, 0, 1], method='index')]==self.d.get_paths([[4, 0, 1]], method='index'))
+
+        with self.assertRaises(ValueError) as cm:
+            self.d.get_paths([[4, 0]], method='index')
+
     def test_iterator(self) -> None:
 
         expected_result = [((0.0, 3.0, 5.0), (test_path / 'run0').absolute()),
@@ -99,6 +130,41 @@ class DatasetTest(unittest.TestCase):
             result.append(entry)
 
         self.assertTrue(result==expected_result)
+        # plain python values as in the keys of the index, not numpy scalars
+        self.assertTrue(all(type(p) in (int, float) for params, _ in result for p in params))
+
+    def test_no_reference_cycle(self) -> None:
+
+        for _ in self.d:
+            pass
+        ref = weakref.ref(self.d)
+
+        gc.disable()
+        try:
+            del self.d
+            self.assertIsNone(ref())
+        finally:
+            gc.enable()
+
+    def test_pack_npy(self) -> None:
+
+        for param, path in self.d:
+            path.mkdir()
+            np.save(path / 'data.npy', np.full((3, 4), param[0] + param[2]))
+
+        self.d.pack_npy()
+        d = Dataset.load(test_path)
+
+        for param, path in d:
+            _, data = d.get_data(param, interpolation=False)
+            self.assertTrue(np.array_equal(data, np.full((3, 4), param[0] + param[2])))
+
+    def test_iter_prefetch(self) -> None:
+
+        expected_result = [(param, path.name) for param, path in self.d]
+        result = list(self.d.iter_prefetch(lambda path: path.name, prefetch=3))
+
+        self.assertTrue(result==expected_result)
 
     def test_dump_load(self) -> None:
 
@@ -114,6 +180,83 @@ class DatasetTest(unittest.TestCase):
         self.assertTrue(self.d._directory == d._directory)
         self.assertTrue(self.d._index == d._index)
 
+    def test_load_pickled(self) -> None:
+
+        # datasets up to version 2.0 pickled the instance into index.he
+        with open(test_path / 'index.he', 'wb') as f:
+            pickle.dump({'version': '2.0'}, f)
+
+        with self.assertRaises(RuntimeError) as cm:
+            Dataset.load(test_path)
+
+        self.assertTrue('2.0 or older' in str(cm.exception))
+
+    def test_dump_load_numpy_meta_data(self) -> None:
+
+        clist = ConfigList(n=np.int64(3), gain=np.float32(0.5), window=np.arange(3), 
+                           path=Path('a/b'))
+        clist.add_config(SimpleSimConfig(x=1.))
+        d = Dataset(test_path, clist)
+        d.dump()
+
+        meta_data = Dataset.load(test_path).meta_data
+        self.assertTrue(meta_data['n'] == 3)
+        self.assertTrue(meta_data['gain'] == 0.5)
+        self.assertTrue(meta_data['window'] == [0, 1, 2])
+        self.assertTrue(meta_data['path'] == str(Path('a/b')))
+
+    def test_pack_hdf5(self) -> None:
+
+        for param, path in self.d:
+            path.mkdir()
+            np.save(path / 'data.npy', np.full((3, 4), param[0] + param[2]))
+
+        self.d.pack_hdf5()
+        d = Dataset.load(test_path)
+
+        for param, path in d:
+            _, data = d.get_data(param, interpolation=False)
+            self.assertTrue(np.array_equal(data, np.full((3, 4), param[0] + param[2])))
+
+    def test_repack_hdf5(self) -> None:
+
+        for param, path in self.d:
+            path.mkdir()
+            np.save(path / 'data.npy', np.full(4, param[0]))
+
+        self.d.pack_hdf5()
+        self.d.get_data((1., 3., 5.), interpolation=False)
+
+        # repack while the dataset still has data.h5 open
+        for param, path in self.d:
+            np.save(path / 'data.npy', np.full(4, param[2]))
+        self.d.pack_hdf5()
+
+        _, data = self.d.get_data((1., 3., 5.), interpolation=False)
+        self.assertTrue(np.array_equal(data, np.full(4, 5.)))
+        self.assertFalse((test_path / 'data.h5.tmp').exists())
+
+    @unittest.skipIf(h5py.h5z.filter_avail(32008), 'bitshuffle filter is available')
+    def test_pack_hdf5_missing_filter(self) -> None:
+
+        for param, path in self.d:
+            path.mkdir()
+            np.save(path / 'data.npy', np.full((3, 4), param[0] + param[2]))
+
+        self.d.pack_hdf5()
+
+        # pretend the file was packed with bitshuffle
+        with open(test_path / 'index.he') as f:
+            index = json.load(f)
+        index['hdf5-filter'] = 32008
+        with open(test_path / 'index.he', 'w') as f:
+            json.dump(index, f)
+
+        d = Dataset.load(test_path)
+
+        with self.assertRaises(RuntimeError) as cm:
+            d.get_data([0., 3., 5.], interpolation=False)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,15 +8,15 @@ Date: Apr. 12, 2021
 import os
 from pathlib import Path
 
-from matplotlib.figure import Figure
-
-import matplotlib
 import unittest
+from unittest import mock
 from hercules import KassLocustP3, SimConfig, ConfigList, Dataset, LocustP3File
+import hercules.eggreader
 import numpy as np
-import matplotlib.pyplot as plt
+import h5py
 import shutil
 
+# matplotlib is only needed by the plotting tests and imported there
 #matplotlib.use("Agg")  # No GUI
 
 module_dir = Path(__file__).parent.absolute()
@@ -93,6 +93,7 @@ class EggReaderTest(unittest.TestCase):
 
     def _load_ts_stream(self, name) -> None:
         # Plot some specific test data
+        import matplotlib.pyplot as plt
 
         file = LocustP3File(str(name / egg_filename))
         n_streams = file.n_streams
@@ -127,6 +128,7 @@ class EggReaderTest(unittest.TestCase):
 
     def _quick_load_ts_stream(self, name) -> None:
         # Plot some specific test data
+        import matplotlib.pyplot as plt
         file = LocustP3File(str(name / egg_filename))
         n_streams = file.n_streams
         n_ch = file.n_channels
@@ -171,6 +173,7 @@ class EggReaderTest(unittest.TestCase):
         self.assertTrue(ok)
 
     def _load_fft_stream(self, name) -> None:
+        import matplotlib.pyplot as plt
 
         file = LocustP3File(str(name / egg_filename))
         n_streams = file.n_streams
@@ -199,6 +202,7 @@ class EggReaderTest(unittest.TestCase):
 
     def _quick_load_fft_stream(self, name) -> None:
         # Plot some specific test data
+        import matplotlib.pyplot as plt
         file = LocustP3File(str(name / egg_filename))
         n_streams = file.n_streams
         n_ch = file.n_channels
@@ -229,9 +233,11 @@ class EggReaderTest(unittest.TestCase):
             #self._save_fig(fig, title)
             plt.show()
 
-    def _save_fig(self, fig: Figure, out_file: str, title: str = None) -> None:
+    def _save_fig(self, fig, out_file: str, title: str = None) -> None:
         # Saves the figure to data/images with title and closes the figure.
         # Default title to axes title if there's only one axes
+        import matplotlib.pyplot as plt
+
         if title is None:
             ax_list = fig.get_axes()
             if len(ax_list) == 1:
@@ -242,5 +248,255 @@ class EggReaderTest(unittest.TestCase):
         plt.close(fig) 
 
 
+synthetic_path = module_dir / 'egg_reader_synthetic'
+
+
+def _write_egg(path, n_ch=3, n_acq=3, n_records=2, record_size=256, ch_format=1,
+               bit_depth=8, analog_dtype=None, seed=0):
+    # Write a minimal egg file with random samples following the egg standard 3.2,
+    # digitized with bit_depth or analog with analog_dtype
+    rng = np.random.default_rng(seed)
+
+    with h5py.File(path, 'w') as f:
+        f.attrs['n_channels'] = n_ch
+        f.attrs['n_streams'] = 1
+        f.attrs['channel_streams'] = np.zeros(n_ch, dtype=int)
+
+        s = f.create_group('streams/stream0')
+        s.attrs.update(n_acquisitions=n_acq, channels=np.arange(n_ch), channel_format=ch_format,
+                       acquisition_rate=250.0, record_size=record_size)
+
+        for i in range(n_acq):
+            if analog_dtype is None:
+                dtype = np.uint8 if bit_depth == 8 else np.uint16
+                data = rng.integers(0, 2**bit_depth, size=(n_records, 2 * n_ch * record_size)).astype(dtype)
+            else:
+                data = rng.normal(size=(n_records, 2 * n_ch * record_size)).astype(analog_dtype)
+            acq = s.create_dataset(f'acquisitions/{i}', data=data)
+            acq.attrs['n_records'] = n_records
+
+        for k in range(n_ch):
+            c = f.create_group(f'channels/channel{k}')
+            c.attrs.update(bit_depth=bit_depth, voltage_range=1.5e-7 * (k + 1),
+                           voltage_offset=-0.75e-7 * (k + 1),
+                           data_format=0 if analog_dtype is None else 2)
+
+
+def _reference_ts(path):
+    # Straightforward conversion of an egg file to volts, one record and channel at a time,
+    # shape (n_acquisitions, n_channels, n_records, record_size)
+    with h5py.File(path, 'r') as f:
+        s = f['streams/stream0']
+        n_ch = len(s.attrs['channels'])
+        ch_format = s.attrs['channel_format']
+        result = []
+
+        for i in range(s.attrs['n_acquisitions']):
+            raw = s[f'acquisitions/{i}'][()].astype(float)
+            samples = raw[:, 0::2] + 1j * raw[:, 1::2]
+            channels = []
+
+            for k in range(n_ch):
+                if ch_format == 1:
+                    ts = samples.reshape(samples.shape[0], n_ch, -1)[:, k]
+                else:
+                    ts = samples[:, k::n_ch]
+
+                attrs = f[f'channels/channel{k}'].attrs
+                if attrs['data_format'] != 2:
+                    scale = attrs['voltage_range'] / (2**attrs['bit_depth'] - 1)
+                    ts = ts * scale + attrs['voltage_offset'] * (1 + 1j)
+                channels.append(ts)
+
+            result.append(channels)
+
+    return np.array(result)
+
+
+def _reference_fft(ts, dft_window):
+    # Orthonormal and shifted DFT of slices of the last axis after subtracting their mean
+    ts = ts[..., :ts.shape[-1] // dft_window * dft_window]
+    ts = ts.reshape(ts.shape[:-1] + (-1, dft_window))
+    ts = ts - ts.mean(axis=-1, keepdims=True)
+    return np.fft.fftshift(np.fft.fft(ts, norm='ortho'), axes=-1)
+
+
+class EggReaderSyntheticTest(unittest.TestCase):
+
+    formats = {'uint8_separate': dict(bit_depth=8, ch_format=1),
+               'uint8_interleaved': dict(bit_depth=8, ch_format=0),
+               'uint16_separate': dict(bit_depth=16, ch_format=1),
+               'uint16_interleaved': dict(bit_depth=16, ch_format=0),
+               'float32_separate': dict(analog_dtype=np.float32, ch_format=1),
+               'float64_interleaved': dict(analog_dtype=np.float64, ch_format=0)}
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        synthetic_path.mkdir(parents=True, exist_ok=True)
+        cls.files = {}
+
+        for i, (name, kwargs) in enumerate(cls.formats.items()):
+            path = synthetic_path / f'{name}.egg'
+            _write_egg(path, seed=i, **kwargs)
+            cls.files[name] = path, _reference_ts(path)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(synthetic_path)
+
+    def _for_all_files(self, check, kernels=True):
+        # run check(file, reference) on every file, with and without the compiled kernel
+        kernel_options = [hercules.eggreader._fill_acquisition_kernel(), None] if kernels else [None]
+
+        for kernel in kernel_options:
+            for name, (path, reference) in self.files.items():
+                with self.subTest(name=name, kernel=kernel is not None), \
+                     mock.patch.object(hercules.eggreader, '_fill_acquisition_kernel', lambda: kernel):
+                    check(LocustP3File(path), reference)
+
+    def assertClose(self, actual, expected, rtol):
+        # tolerance relative to the largest value, single elements can be close to zero
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertTrue(np.allclose(actual, expected, rtol=0, atol=rtol * np.abs(expected).max()))
+
+    def test_load_ts_stream(self) -> None:
+
+        def check(file, reference):
+            data = file.load_ts_stream()
+            self.assertEqual(list(data.keys()), [0, 1, 2])
+            for k, ts in data.items():
+                # (n_acquisitions, n_records, record_size)
+                self.assertEqual(ts.shape, (3, 2, 256))
+                self.assertClose(ts, reference[:, k], 1e-6)
+
+        self._for_all_files(check)
+
+    def test_quick_load_ts_stream(self) -> None:
+
+        def check(file, reference):
+            data = file.quick_load_ts_stream()
+            expected = reference.reshape(reference.shape[:2] + (-1,))
+            self.assertEqual(data.shape, (3, 3, 512))
+            self.assertTrue(data.flags.c_contiguous)
+            self.assertClose(data, expected, 1e-6)
+
+        self._for_all_files(check)
+
+    def test_ts_dtype(self) -> None:
+        # digitized data is converted in double precision, analog data keeps its precision
+        expected = {'uint8_separate': np.complex128,
+                    'uint16_separate': np.complex128,
+                    'float32_separate': np.complex64,
+                    'float64_interleaved': np.complex128}
+
+        for name, dtype in expected.items():
+            file = LocustP3File(self.files[name][0])
+            self.assertEqual(file.quick_load_ts_stream().dtype, dtype)
+            self.assertEqual(file.load_ts_stream()[0].dtype, dtype)
+            self.assertEqual(file.quick_load_ts_stream(dtype=np.complex64).dtype, np.complex64)
+
+    def test_load_fft_stream(self) -> None:
+
+        def check(file, reference):
+            frequency, data = file.load_fft_stream(64)
+            # (n_channels, n_acquisitions, n_records, n_slices, dft_window)
+            expected = _reference_fft(reference, 64)
+
+            self.assertEqual(list(data.keys()), [0, 1, 2])
+            for k, spectrum in data.items():
+                self.assertEqual(spectrum.dtype, np.complex64)
+                self.assertEqual(spectrum.shape, (3, 2, 4, 64))
+                self.assertClose(spectrum, expected[:, k], 1e-4)
+
+            freq, data = file.load_fft_stream(64, dtype=np.complex128)
+            self.assertEqual(data[0].dtype, np.complex128)
+            self.assertClose(data[1], expected[:, 1], 1e-9)
+
+        self._for_all_files(check)
+
+    def test_quick_load_fft_stream(self) -> None:
+
+        def check(file, reference):
+            frequency, data = file.quick_load_fft_stream(100, dtype=np.complex128)
+            # the records are concatenated before slicing, the remainder is discarded
+            expected = _reference_fft(reference.reshape(reference.shape[:2] + (-1,)), 100)
+
+            self.assertEqual(data.shape, (3, 3, 5, 100))
+            self.assertClose(data, expected, 1e-9)
+            self.assertEqual(file.quick_load_fft_stream(100)[1].dtype, np.complex64)
+
+        self._for_all_files(check)
+
+    def test_fft_backends(self) -> None:
+        # FFTW if pyfftw is installed and scipy otherwise give the same spectra
+        path, reference = self.files['uint16_separate']
+        expected = _reference_fft(reference.reshape(reference.shape[:2] + (-1,)), 128)
+
+        for builders in [hercules.eggreader._fftw_builders(), None]:
+            with self.subTest(fftw=builders is not None), \
+                 mock.patch.object(hercules.eggreader, '_fftw_builders', lambda: builders):
+                file = LocustP3File(path)
+                for _ in range(2):
+                    _, data = file.quick_load_fft_stream(128, dtype=np.complex128)
+                    self.assertClose(data, expected, 1e-9)
+
+    def test_frequency_axis(self) -> None:
+        file = LocustP3File(self.files['uint8_separate'][0])
+        frequency, _ = file.load_fft_stream(64)
+        frequency_quick, _ = file.quick_load_fft_stream(64)
+
+        expected = np.fft.fftshift(np.fft.fftfreq(64, d=1 / 250e6))
+        self.assertTrue(np.allclose(frequency, expected))
+        self.assertTrue(np.array_equal(frequency, frequency_quick))
+        self.assertFalse(frequency.flags.writeable)
+
+    def test_prepare_fft(self) -> None:
+        file = LocustP3File(self.files['uint8_separate'][0])
+        frequency, do_fft = file.prepare_fft(32)
+
+        self.assertIs(file.prepare_fft(32)[1], do_fft)
+        self.assertEqual(len(frequency), 32)
+
+        ts = np.exp(2j * np.pi * 4 * np.arange(32) / 32) + 1.
+        spectrum = do_fft(ts.copy())
+        # the mean is removed and the tone ends up at bin 4 after the shift
+        self.assertAlmostEqual(abs(spectrum[16 + 4]), np.sqrt(32))
+        self.assertAlmostEqual(np.abs(spectrum).sum(), np.sqrt(32))
+
+        out = np.empty(32, dtype=complex)
+        self.assertIs(do_fft(ts.copy(), out=out), out)
+        self.assertTrue(np.allclose(out, spectrum))
+
+        with self.assertRaises(ValueError):
+            do_fft(np.zeros(16, dtype=complex))
+
+    def test_cache_bytes(self) -> None:
+        path, reference = self.files['uint16_interleaved']
+        data = LocustP3File(path, cache_bytes=0).quick_load_ts_stream()
+        self.assertClose(data, reference.reshape(3, 3, -1), 1e-6)
+
+    def test_iter_stream(self) -> None:
+        path, reference = self.files['uint8_interleaved']
+        channels, shape, dtype, acquisitions = LocustP3File(path)._iter_stream(0)
+
+        self.assertEqual(shape, (3, 2, 3, 256))
+        self.assertEqual(dtype, np.complex128)
+
+        # every acquisition is a separate array even though the raw buffer is reused
+        acquisitions = list(acquisitions)
+        self.assertEqual(len(acquisitions), 3)
+        for i, acq in enumerate(acquisitions):
+            self.assertClose(acq.swapaxes(0, 1), reference[i], 1e-6)
+
+    def test_non_finite(self) -> None:
+        path = synthetic_path / 'nan.egg'
+        _write_egg(path, analog_dtype=np.float32)
+        with h5py.File(path, 'r+') as f:
+            f['streams/stream0/acquisitions/1'][0, 5] = np.nan
+
+        with self.assertRaises(ValueError):
+            LocustP3File(path).quick_load_ts_stream()
+
+
 if __name__ == '__main__':
     unittest.main()